@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""Benchmarks of the hot paths of the classification tools.
+
+A reproducible corpus of synthetic font families is built offline with
+fontTools' FontBuilder: every glyph is a box whose stem thickness follows
+the weight of the style, and whose width varies per family. Half of the
+families come with a METADATA.pb, the other half rely on their filenames
+(and name tables) for GFN resolution, like the real collection.
+
+The timings are written as JSON, so that the results of two commits can
+be compared:
+
+  benchmark.py -o before.json
+  git checkout my-branch
+  benchmark.py -o after.json
+
+Raster rendering benchmarks (and the thumbnail route) are skipped when
+pycairo is missing, and the web routes when flask is.
+"""
+import argparse
+import csv
+import datetime
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+  from fontTools.fontBuilder import FontBuilder
+  from fontTools.pens.ttGlyphPen import TTGlyphPen
+except ImportError:
+  sys.exit("Needs fontTools.\n\npip3 install fonttools")
+
+from gfn import (GFNResolver,
+                 GFN_from_filename)
+import util
+from util import (LATIN_TEXT,
+                  read_csv,
+                  save_csv)
+
+DESCRIPTION = "Times the hot paths of the classification tools on a synthetic font corpus."
+parser = argparse.ArgumentParser(description=DESCRIPTION)
+parser.add_argument("-o", "--output", default="benchmark-results.json",
+                    help="JSON file the results are written to")
+parser.add_argument("-c", "--corpus", default=None,
+                    help="Directory for the synthetic corpus (defaults to a temporary"
+                         " directory). An existing corpus built with the same settings is reused.")
+parser.add_argument("-n", "--families", default=200, type=int,
+                    help="Number of synthetic families")
+parser.add_argument("--seed", default=0, type=int,
+                    help="Seed for the family parameters")
+parser.add_argument("-r", "--repeat", default=5, type=int,
+                    help="How many times each benchmark is run")
+parser.add_argument("--render-fonts", default=100, type=int,
+                    help="How many fonts are rendered by the rendering benchmarks")
+
+UPM = 1000
+X_HEIGHT = 500
+CAP_HEIGHT = 700
+STYLES = [("Thin", 100), ("Light", 300), ("Regular", 400), ("Medium", 500),
+          ("Bold", 700), ("Black", 900)]
+FAMILY_STEMS = [("Sans", 1.0), ("Condensed", 0.75), ("Wide", 1.3)]
+
+
+def _family_name(index):
+  """Letters only, so that the names parsed from the filenames match."""
+  letters = ""
+  for _ in range(4):
+    index, digit = divmod(index, 26)
+    letters += chr(ord("a") + digit)
+  return "Synth " + letters.capitalize()
+
+
+def _box_glyph(width, height, stem, slant):
+  """A rectangle with a rectangular counter, sheared by slant."""
+  pen = TTGlyphPen(None)
+  def contour(points):
+    pen.moveTo(points[0])
+    for point in points[1:]:
+      pen.lineTo(point)
+    pen.closePath()
+  def sheared(x, y):
+    return (int(x + y * slant), y)
+  contour([sheared(x, y) for x, y in [(0, 0), (0, height), (width, height), (width, 0)]])
+  if width > 2 * stem and height > 2 * stem:
+    contour([sheared(x, y) for x, y in [(stem, stem), (width - stem, stem),
+                                        (width - stem, height - stem), (stem, height - stem)]])
+  return pen.glyph()
+
+
+def _style_name(style, italic):
+  if italic:
+    return ("" if style == "Regular" else style) + "Italic"
+  return style
+
+
+def build_font(path, family, style, weight, width_factor, italic):
+  chars = sorted(set(LATIN_TEXT + "x"))
+  names = {c: "uni{:04X}".format(ord(c)) for c in chars}
+  stem = 20 + weight // 5
+  slant = 0.2 if italic else 0.0
+
+  glyphs = {".notdef": _box_glyph(400, CAP_HEIGHT, 40, 0), "space": TTGlyphPen(None).glyph()}
+  metrics = {".notdef": (500, 0), "space": (250, 0)}
+  for c in chars:
+    height = CAP_HEIGHT if c.isupper() else X_HEIGHT
+    width = int((400 if c.isupper() else 300) * width_factor) + stem
+    glyphs[names[c]] = _box_glyph(width, height, stem, slant)
+    metrics[names[c]] = (width + 60, 30)
+
+  fb = FontBuilder(UPM, isTTF=True)
+  fb.setupGlyphOrder([".notdef", "space"] + [names[c] for c in chars])
+  cmap = {ord(c): names[c] for c in chars}
+  cmap[ord(" ")] = "space"
+  fb.setupCharacterMap(cmap)
+  fb.setupGlyf(glyphs)
+  fb.setupHorizontalMetrics(metrics)
+  fb.setupHorizontalHeader(ascent=900, descent=-200)
+  fb.setupNameTable({"familyName": family, "styleName": _style_name(style, italic)})
+  fb.setupOS2(usWeightClass=weight, sxHeight=X_HEIGHT, sCapHeight=CAP_HEIGHT,
+              sTypoAscender=900, sTypoDescender=-200, usWinAscent=900, usWinDescent=200)
+  fb.setupPost(italicAngle=-11.3 if italic else 0)
+  fb.save(path)
+
+
+def _metadata_pb(family, fonts):
+  lines = ['name: "{}"'.format(family),
+           'designer: "Benchmark"',
+           'license: "OFL"',
+           'category: "SANS_SERIF"',
+           'date_added: "2018-01-01"']
+  for filename, italic, weight in fonts:
+    lines += ['fonts {',
+              '  name: "{}"'.format(family),
+              '  style: "{}"'.format("italic" if italic else "normal"),
+              '  weight: {}'.format(weight),
+              '  filename: "{}"'.format(filename),
+              '  post_script_name: "{}"'.format(os.path.splitext(filename)[0]),
+              '  full_name: "{}"'.format(os.path.splitext(filename)[0]),
+              '}']
+  lines.append('subsets: "latin"')
+  return "\n".join(lines) + "\n"
+
+
+def build_corpus(corpus, families, seed):
+  """Creates the synthetic families under corpus/ofl/, plus a metadata
+     CSV listing all of them. Returns the list of font files."""
+  settings = {"families": families, "seed": seed}
+  settings_path = os.path.join(corpus, "corpus.json")
+  if os.path.exists(settings_path):
+    with open(settings_path) as f:
+      if json.load(f) == settings:
+        with open(os.path.join(corpus, "fonts.json")) as f:
+          return json.load(f)
+    shutil.rmtree(os.path.join(corpus, "ofl"), ignore_errors=True)
+
+  rng = random.Random(seed)
+  fontfiles = []
+  for index in range(families):
+    kind, width_factor = rng.choice(FAMILY_STEMS)
+    family = "{} {}".format(_family_name(index), kind)
+    prefix = family.replace(" ", "")
+    fontdir = os.path.join(corpus, "ofl", prefix.lower())
+    os.makedirs(fontdir, exist_ok=True)
+    styles = rng.sample(STYLES, rng.randint(1, 4))
+    if ("Regular", 400) not in styles:
+      styles.append(("Regular", 400))
+
+    fonts = []
+    for style, weight in sorted(styles, key=lambda s: s[1]):
+      for italic in ([False, True] if rng.random() < 0.5 else [False]):
+        filename = "{}-{}.ttf".format(prefix, _style_name(style, italic))
+        build_font(os.path.join(fontdir, filename), family, style, weight,
+                   width_factor, italic)
+        fonts.append((filename, italic, weight))
+        fontfiles.append(os.path.join(fontdir, filename))
+
+    if index % 2 == 0:
+      with open(os.path.join(fontdir, "METADATA.pb"), "w") as f:
+        f.write(_metadata_pb(family, fonts))
+
+  resolver = GFNResolver()
+  with open(os.path.join(corpus, "font-metadata.csv"), "w") as f:
+    writer = csv.writer(f, lineterminator="\n")
+    writer.writerow(["GFN", "FWE", "FIA", "FWI", "USAGE", "SUBSETS"])
+    for fontfile in fontfiles:
+      gfn = GFN_from_filename(fontfile, resolver)
+      writer.writerow([gfn, rng.randint(1, 10), rng.randint(1, 10),
+                       rng.randint(1, 10), rng.choice(["body", "header"]), "latin"])
+
+  with open(os.path.join(corpus, "fonts.json"), "w") as f:
+    json.dump(fontfiles, f)
+  with open(settings_path, "w") as f:
+    json.dump(settings, f)
+  return fontfiles
+
+
+def timed(function, repeat, items=None, setup=None):
+  """Runs function() repeat times and summarizes the wall clock times.
+     setup(), if given, runs untimed before every run."""
+  times = []
+  for _ in range(repeat):
+    if setup is not None:
+      setup()
+    start = time.perf_counter()
+    function()
+    times.append(time.perf_counter() - start)
+  result = {"runs": repeat,
+            "min": min(times),
+            "median": statistics.median(times),
+            "mean": statistics.mean(times)}
+  if items:
+    result["items"] = items
+    result["per_item_median"] = result["median"] / items
+  return result
+
+
+def bench_gfn(fontfiles, repeat):
+  results = {}
+  # a new resolver per run, so nothing is memoized between runs:
+  state = {}
+  def setup():
+    state["resolver"] = GFNResolver()
+  def resolve_all():
+    for fontfile in fontfiles:
+      GFN_from_filename(fontfile, state["resolver"])
+  results["gfn.resolve_cold"] = timed(resolve_all, repeat, len(fontfiles), setup)
+  results["gfn.resolve_warm"] = timed(resolve_all, repeat, len(fontfiles))
+  return results
+
+
+def bench_csv(corpus, repeat):
+  results = {}
+  csv_path = os.path.join(corpus, "font-metadata.csv")
+  metadata = read_csv(csv_path)
+  results["util.read_csv"] = timed(lambda: read_csv(csv_path), repeat, len(metadata))
+  output = os.path.join(corpus, "benchmark-output.csv")
+  results["util.save_csv"] = timed(lambda: save_csv(output, metadata), repeat, len(metadata))
+  return results
+
+
+def bench_render(fontfiles, repeat):
+  results = {}
+  # the Computing... lines would drown the benchmark output:
+  devnull = open(os.devnull, "w")
+  def measure_all(engine):
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+      for fontfile in fontfiles:
+        util.compute_darkness_and_width(fontfile, "latin", engine=engine)
+    finally:
+      sys.stdout = stdout
+
+  if util.cairo is None:
+    results["util.compute_darkness_and_width"] = {"skipped": "pycairo is not installed"}
+  else:
+    results["util.compute_darkness_and_width_cold"] = \
+      timed(lambda: measure_all("raster"), repeat, len(fontfiles), util.clear_face_cache)
+    results["util.compute_darkness_and_width_warm"] = \
+      timed(lambda: measure_all("raster"), repeat, len(fontfiles))
+  results["util.compute_darkness_and_width_outline"] = \
+    timed(lambda: measure_all("outline"), repeat, len(fontfiles))
+  devnull.close()
+  return results
+
+
+def _load_web_tool():
+  path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      "font-classification-tool.py")
+  spec = importlib.util.spec_from_file_location("font_classification_tool_app", path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+def bench_web(corpus, fontfiles, repeat):
+  try:
+    tool = _load_web_tool()
+  except SystemExit as e:
+    return {"web": {"skipped": str(e).splitlines()[0]}}
+
+  workdir = tempfile.mkdtemp(prefix="web-", dir=corpus)
+  args = tool.parser.parse_args(["--files", os.path.join(corpus, "ofl"),
+                                 "--existing", os.path.join(corpus, "font-metadata.csv"),
+                                 "--output", os.path.join(workdir, "output.csv"),
+                                 "--thumbnails", os.path.join(workdir, "thumbnails")])
+  results = {}
+  start = time.perf_counter()
+  app = tool.create_app(args)
+  results["web.create_app"] = {"runs": 1, "min": time.perf_counter() - start}
+  client = app.test_client()
+
+  def get(url, **kwargs):
+    response = client.get(url, **kwargs)
+    assert response.status_code in (200, 304), (url, response.status_code)
+    return response
+
+  etag = get("/data.json").headers["ETag"]
+  results["web.data_json"] = timed(lambda: get("/data.json"), repeat)
+  results["web.data_json_gzip"] = timed(
+    lambda: get("/data.json", headers={"Accept-Encoding": "gzip"}), repeat)
+  results["web.data_json_not_modified"] = timed(
+    lambda: get("/data.json", headers={"If-None-Match": etag}), repeat)
+  results["web.query_json"] = timed(
+    lambda: get("/query.json?sort=weight_int&order=desc&page=2&usage=body"), repeat)
+
+  state = {"value": 0}
+  def update():
+    state["value"] = state["value"] % 10 + 1
+    response = client.post("/update", data={"id": "1", "colname": "weight_int",
+                                            "newvalue": str(state["value"])})
+    assert response.status_code == 200
+  results["web.update"] = timed(update, repeat)
+
+  if util.cairo is None:
+    results["web.thumb"] = {"skipped": "pycairo is not installed"}
+  else:
+    gfns = [GFN_from_filename(fontfile) for fontfile in fontfiles]
+    def thumbnails():
+      for gfn in gfns:
+        get("/thumb/" + tool.quote(gfn))
+    def clear():
+      shutil.rmtree(args.thumbnails, ignore_errors=True)
+      os.makedirs(args.thumbnails)
+    results["web.thumb_cold"] = timed(thumbnails, repeat, len(gfns), clear)
+    results["web.thumb_cached"] = timed(thumbnails, repeat, len(gfns))
+  shutil.rmtree(workdir, ignore_errors=True)
+  return results
+
+
+def _git_revision():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                   cwd=os.path.dirname(os.path.abspath(__file__)),
+                                   stderr=subprocess.DEVNULL).decode("ascii").strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main():
+  args = parser.parse_args()
+
+  corpus = args.corpus or tempfile.mkdtemp(prefix="font-classification-benchmark-")
+  os.makedirs(corpus, exist_ok=True)
+  start = time.perf_counter()
+  fontfiles = build_corpus(corpus, args.families, args.seed)
+  print ("Corpus of {} fonts in {} ({:.1f}s)".format(len(fontfiles), corpus,
+                                                    time.perf_counter() - start))
+
+  render_fonts = random.Random(args.seed).sample(fontfiles, min(args.render_fonts, len(fontfiles)))
+  benchmarks = {}
+  for name, run in [("gfn", lambda: bench_gfn(fontfiles, args.repeat)),
+                    ("csv", lambda: bench_csv(corpus, args.repeat)),
+                    ("render", lambda: bench_render(render_fonts, args.repeat)),
+                    ("web", lambda: bench_web(corpus, render_fonts, args.repeat))]:
+    print ("Running the {} benchmarks...".format(name))
+    benchmarks.update(run())
+
+  for name, result in sorted(benchmarks.items()):
+    if "skipped" in result:
+      print ("{:45} skipped: {}".format(name, result["skipped"]))
+    else:
+      print ("{:45} {:10.4f}s".format(name, result.get("median", result["min"])))
+
+  results = {"revision": _git_revision(),
+             "date": datetime.datetime.now().isoformat(),
+             "python": platform.python_version(),
+             "platform": platform.platform(),
+             "corpus": {"families": args.families, "seed": args.seed,
+                        "fonts": len(fontfiles), "rendered_fonts": len(render_fonts)},
+             "benchmarks": benchmarks}
+  with open(args.output, "w") as f:
+    json.dump(results, f, indent=2, sort_keys=True)
+  print ("Results written to {}".format(args.output))
+
+  if not args.corpus:
+    shutil.rmtree(corpus, ignore_errors=True)
+
+
+if __name__ == "__main__":
+  main()
@@ -1,66 +1,403 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 import argparse
+import collections
+import os
 import sys
-import glob
-from gfn import (GFNs_from_filenames,
-                 GFN_from_filename)
-from util import (group_by_attributes,
+import profiling
+from discovery import discover_font_files
+from gfn import GFNIndex
+from variable_fonts import (font_instances,
+                            instance_gfn,
+                            parse_axis_grid)
+from util import (ENGINES,
+                  angle_score,
+                  measure_fonts,
+                  normalize,
+                  shard_of,
+                  append_raw_measurements,
+                  read_raw_rows,
+                  read_raw_measurements,
                   save_csv,
                   read_csv,
-                  is_blacklisted)
+                  is_blocklisted,
+                  require_cairo)
+from supervised_pool import (Quarantine,
+                             is_fatal,
+                             DEFAULT_QUARANTINE_PATH,
+                             DEFAULT_MEMORY_LIMIT,
+                             DEFAULT_TIMEOUT)
+from measurement_cache import (MeasurementCache,
+                               DEFAULT_CACHE_PATH,
+                               DEFAULT_MAX_ENTRIES)
 
-DESCRIPTION = "Compute the weight value for all given font files."
-parser = argparse.ArgumentParser(description=DESCRIPTION)
-parser.add_argument("-f", "--files", default="*", required=True, nargs="+",
-                    help="The pattern to match for finding ttfs, eg 'folder_with_fonts/*.ttf'.")
-parser.add_argument("-o", "--output", default="output.csv", required=True,
+
+def shard_spec(value):
+  """Parses an "i/N" shard specification into an (i, N) tuple."""
+  try:
+    index, count = [int(v) for v in value.split("/")]
+  except ValueError:
+    raise argparse.ArgumentTypeError("expected i/N, got '{}'".format(value))
+  if not 0 <= index < count:
+    raise argparse.ArgumentTypeError("shard index must be in 0..{}".format(count - 1))
+  return index, count
+
+
+DESCRIPTION = """Compute the weight value for all given font files.
+
+  The work is split in two stages that can also be run separately:
+  "measure" renders the fonts and records their raw darkness, width and
+  italic angle, and "normalize" turns raw values into 1-10 scores (angles
+  get binned 3 degrees apart rather than normalized). With --raw, raw
+  values are appended to (and normalized from) a sidecar file, so that
+  adding a family only takes measuring it and normalizing again:
+
+    classify.py --stage measure -f fonts/ofl/newfamily/*.ttf -i font-metadata.csv --raw raw.csv
+    classify.py --stage normalize -i font-metadata.csv --raw raw.csv -o output.csv
+
+  A full reclassification can be split across N machines with --shard,
+  each one measuring the fonts whose GFN hashes to its shard, and then
+  merged and normalized in one go:
+
+    classify.py --shard 0/4 -f "fonts/*/*/*.ttf" -i font-metadata.csv --raw shard0.csv
+    ...
+    classify.py --stage merge --shards shard*.csv -i font-metadata.csv -o output.csv
+"""
+parser = argparse.ArgumentParser(description=DESCRIPTION,
+                                 formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("-f", "--files", default=None, nargs="+",
+                    help="The patterns to match for finding ttfs, eg 'folder_with_fonts/*.ttf',"
+                         " or directories to search for font files.")
+parser.add_argument("-o", "--output", default=None,
                     help="CSV metadata output filename")
 parser.add_argument("-i", "--input", default="input.csv", required=True,
                     help="CSV metadata input filename")
+parser.add_argument("-s", "--stage", default="all", choices=["all", "measure", "normalize", "merge"],
+                    help="Which stage of the classification to run")
+parser.add_argument("--shard", default=None, type=shard_spec,
+                    help="Only measure the fonts of shard i out of N (given as i/N)."
+                         " Implies --stage measure.")
+parser.add_argument("--shards", default=[], nargs="+",
+                    help="Raw measurement files of every shard, for the merge stage")
+parser.add_argument("-r", "--raw", default=None,
+                    help="Raw measurements file, appended to by the measure stage"
+                         " and read by the normalize stage")
+parser.add_argument("-e", "--engine", default="raster", choices=ENGINES,
+                    help="How darkness and width are measured: by rendering the sample text"
+                         " (raster), or from the glyph outlines (outline, much faster and without"
+                         " pixel rounding). Don't mix engines within one raw measurements file.")
+parser.add_argument("--instances", default=False, action='store_true',
+                    help="Measure every named instance of variable fonts as a font of its own,"
+                         " with a GFN made of the family name and the instance's style and weight."
+                         " All the instances of a font are measured from a single load of it.")
+parser.add_argument("--axis-grid", default=None, nargs="+", metavar="AXIS=VALUES",
+                    help="Measure these points of the variation axes instead of the named"
+                         " instances, eg wght=100:900:100 or wdth=75,100. Implies --instances.")
+parser.add_argument("-j", "--jobs", default=1, type=int,
+                    help="Number of worker processes used for rendering the fonts")
+parser.add_argument("--gfn-index", default=None,
+                    help="Optional file for persisting resolved GFNs between runs")
+parser.add_argument("--cache", default=DEFAULT_CACHE_PATH,
+                    help="Path to the on-disk cache of raw measurements")
+parser.add_argument("--cache-size", default=DEFAULT_MAX_ENTRIES, type=int,
+                    help="Maximum number of entries kept in the measurement cache")
+parser.add_argument("--no-cache", default=False, action='store_true',
+                    help="Neither read nor update the measurement cache")
+parser.add_argument("--rebuild-cache", default=False, action='store_true',
+                    help="Discard every cached measurement and render all fonts again")
+parser.add_argument("--timeout", default=DEFAULT_TIMEOUT, type=float,
+                    help="Seconds a font may take to render before its worker is killed"
+                         " and the font is quarantined (0 disables the limit)")
+parser.add_argument("--memory-limit", default=DEFAULT_MEMORY_LIMIT, type=int,
+                    help="Address space limit of each worker process, in MB (0 disables the"
+                         " limit). Workers are only supervised if one of the limits is set.")
+parser.add_argument("--quarantine", default=DEFAULT_QUARANTINE_PATH,
+                    help="File recording the fonts that hung or crashed a worker; they are"
+                         " skipped by later runs. Pass an empty string to disable it.")
+parser.add_argument("--retry-quarantined", default=False, action='store_true',
+                    help="Measure quarantined fonts again, and release those that succeed")
+parser.add_argument("--profile", default=None, metavar="TRACE",
+                    help="Time every stage of the run, print the slowest stages and fonts,"
+                         " and save a Chrome trace (chrome://tracing) to TRACE")
 
-def main():
-  args = parser.parse_args()
+def measure(args, old_metadata):
+  """Renders every given font file that is listed in the old metadata
+     and returns a list of (gfn, darkness, width) tuples.
 
-  if len(sys.argv) < 2:
-    parser.print_help()
-    sys.exit(-1)
+     Font files are discovered, resolved and measured as a stream, so
+     rendering starts while the directories are still being walked."""
+  if args.engine == "raster":
+    require_cairo()
+  GFNs = GFNIndex(args.gfn_index)
+  blacklisted = []
+  quarantined = []
+  quarantine = Quarantine(args.quarantine) if args.quarantine else None
+  # (font file, variable font Instance):GFN
+  instance_gfns = {}
+  claimed_gfns = set()
+  axis_grid = None
+  if args.axis_grid:
+    try:
+      axis_grid = parse_axis_grid(args.axis_grid)
+    except ValueError as e:
+      sys.exit(str(e))
 
-  files_to_process = []
-  for pattern in args.files:
-    files_to_process.extend(glob.glob(pattern))
+  def fonts_to_process():
+    files = discover_font_files(args.files)
+    while True:
+      with profiling.stage("discover"):
+        fname = next(files, None)
+      if fname is None:
+        break
+      if is_blocklisted(fname):
+        blacklisted.append(fname)
+        continue
+      with profiling.stage("gfn", fname):
+        gfn = GFNs[fname]
 
-  old_metadata = read_csv(args.input)
-  print("There are {} entries in the old metadata CSV.".format(len(old_metadata.keys())))
+      instances = None
+      if args.instances:
+        try:
+          instances = font_instances(fname, axis_grid)
+        except Exception as e:
+          print ("Failed to measure {} ({}): {}: {}".format(fname, gfn, type(e).__name__, e))
+          continue
+      if instances is not None:
+        # measure the instances that have a GFN of their own:
+        wanted = []
+        for instance in instances:
+          gfn_of_instance = instance_gfn(gfn, instance)
+          if gfn_of_instance not in old_metadata or gfn_of_instance in claimed_gfns:
+            continue
+          if args.shard and shard_of(gfn_of_instance, args.shard[1]) != args.shard[0]:
+            continue
+          # (grid points differing only in width share a GFN)
+          claimed_gfns.add(gfn_of_instance)
+          instance_gfns[(fname, instance)] = gfn_of_instance
+          wanted.append(instance)
+        if not wanted:
+          continue
+        subsets = old_metadata[instance_gfns[(fname, wanted[0])]]['subsets']
+      else:
+        if gfn not in old_metadata:
+          continue
+        if args.shard and shard_of(gfn, args.shard[1]) != args.shard[0]:
+          continue
+        subsets = old_metadata[gfn]['subsets']
+
+      if quarantine is not None and not args.retry_quarantined:
+        reason = quarantine.reason(fname)
+        if reason is not None:
+          quarantined.append("{} ({})".format(fname, reason))
+          continue
+      if instances is not None:
+        yield fname, subsets, wanted
+      else:
+        yield fname, subsets
+
+  cache = None
+  if not args.no_cache:
+    cache = MeasurementCache(args.cache, args.cache_size)
+    if args.rebuild_cache:
+      cache.clear()
 
-  blacklisted = [fname for fname in files_to_process if is_blacklisted(fname)]
-  files_to_process = [fname for fname in files_to_process if not is_blacklisted(fname) and \
-                                                             GFN_from_filename(fname) in old_metadata.keys()]
+  processed = 0
+  measurements = []
+  newly_quarantined = set()
+  for fname, instance, darkness, width, angle, error in measure_fonts(fonts_to_process(),
+                                                                      jobs=args.jobs,
+                                                                      cache=cache,
+                                                                      timeout=args.timeout,
+                                                                      memory_limit=args.memory_limit,
+                                                                      engine=args.engine):
+    processed += 1
+    if instance is not None:
+      gfn = instance_gfns[(fname, instance)]
+    else:
+      gfn = GFNs[fname]
+    if error is not None:
+      print ("Failed to measure {} ({}): {}".format(fname, gfn, error))
+      if quarantine is not None and is_fatal(error) and fname not in newly_quarantined:
+        quarantine.add(fname, error)
+        newly_quarantined.add(fname)
+      continue
+    if quarantine is not None and args.retry_quarantined:
+      quarantine.remove(fname)
+    measurements.append((gfn, darkness, width, angle))
+
+  if cache is not None:
+    cache.close()
+  if args.gfn_index:
+    GFNs.save()
 
   if blacklisted:
     print ("{} font files were blacklisted:\n".format(len(blacklisted)))
     print ("".join(map("* {}\n".format, blacklisted)))
 
-  if len(files_to_process) == 0:
+  if quarantined:
+    print ("{} font files were skipped, as they are quarantined:\n".format(len(quarantined)))
+    print ("".join(map("* {}\n".format, quarantined)))
+
+  if quarantine is not None and quarantine.changed:
+    quarantine.save()
+    if newly_quarantined:
+      print ("{} font files hung or crashed and were added to the quarantine in {}".format(
+        len(newly_quarantined), quarantine.path))
+
+  if processed == 0:
     sys.exit("Nothing to do! Aborting.")
   else:
-    print("Will process {} font files.".format(len(files_to_process)))
+    print("Processed {} fonts.".format(processed))
+  return measurements
 
 
-  fonts = [(fname, old_metadata[GFN_from_filename(fname)]['subsets']) for fname in files_to_process]
-  weights, widths = group_by_attributes(fonts)
-  GFNs = GFNs_from_filenames(files_to_process)
+def normalize_into(old_metadata, darkness, width, angle):
+  """Returns the entries of old_metadata that have raw measurements,
+     with their weight and width replaced by the normalized scores, and
+     their angle by its binned score (where the angle was measured)."""
+  weights = normalize(darkness)
+  widths = normalize(width)
 
   metadata = {}
-  for fname in files_to_process:
-    gfn = GFNs[fname]
+  for gfn in darkness:
     if gfn in old_metadata.keys():
       metadata[gfn] = old_metadata[gfn] # preserve every old value
-      metadata[gfn]['weight_int'] = weights[fname] # except the new weight 
-      metadata[gfn]['width_int'] = widths[fname] # and width values we have just computed
+      metadata[gfn]['weight_int'] = weights[gfn] # except the new weight
+      metadata[gfn]['width_int'] = widths[gfn] # and width values we have just computed
+      if gfn in angle:
+        metadata[gfn]['angle_int'] = angle_score(angle[gfn]) # and the angle too
+  return metadata
+
+
+def merge_shards(filenames):
+  """Combines the raw measurements of every shard of a run.
 
-  if args.output:
+     Returns (darkness, width, angle, problems), where problems lists the
+     duplicated GFNs, misassigned GFNs and missing shards found.
+  """
+  darkness = collections.OrderedDict()
+  width = collections.OrderedDict()
+  angle = collections.OrderedDict()
+  problems = []
+  owners = {}
+  measured = set()
+  shard_files = {}
+  conflicts = set()
+  count = None
+  # the same file given twice (eg by overlapping globs) only counts once:
+  unique = collections.OrderedDict((os.path.realpath(f), f) for f in filenames)
+  for filename in unique.values():
+    for gfn, dark, wide, slant, shard in read_raw_rows(filename):
+      if shard is None:
+        problems.append("{}: '{}' was not measured as part of a shard".format(filename, gfn))
+        continue
+      try:
+        index, shard_count = shard_spec(shard)
+      except argparse.ArgumentTypeError as e:
+        problems.append("{}: bad shard '{}' for '{}': {}".format(filename, shard, gfn, e))
+        continue
+      if count is None:
+        count = shard_count
+      elif shard_count != count:
+        problems.append("{}: shard {} doesn't belong to a run of {} shards".format(filename, shard, count))
+        continue
+      if shard_files.setdefault(index, filename) != filename and (index, filename) not in conflicts:
+        conflicts.add((index, filename))
+        problems.append("shard {} is in both {} and {}".format(shard, shard_files[index], filename))
+      if shard_of(gfn, count) != index:
+        problems.append("{}: '{}' doesn't belong to shard {}".format(filename, gfn, shard))
+      if (filename, gfn) in measured:
+        # eg a shard file that several runs appended to
+        problems.append("'{}' was measured more than once in {}".format(gfn, filename))
+      elif owners.setdefault(gfn, filename) != filename:
+        problems.append("'{}' was measured in both {} and {}".format(gfn, owners[gfn], filename))
+      measured.add((filename, gfn))
+      darkness[gfn] = dark
+      width[gfn] = wide
+      if slant is not None:
+        angle[gfn] = slant
+
+  if count is not None:
+    for index in range(count):
+      if index not in shard_files:
+        problems.append("no measurements for shard {}/{}".format(index, count))
+  return darkness, width, angle, problems
+
+
+def run(args):
+  if args.axis_grid:
+    args.instances = True
+  if args.shard:
+    args.stage = "measure"
+  if args.stage == "merge" and not args.shards:
+    parser.error("the merge stage needs --shards")
+  if args.stage not in ["normalize", "merge"] and not args.files:
+    parser.error("the {} stage needs --files".format(args.stage))
+  if args.stage == "measure" and not args.raw:
+    parser.error("the measure stage needs --raw")
+  if args.stage == "normalize" and not args.raw:
+    parser.error("the normalize stage needs --raw")
+  if args.stage != "measure" and not args.output:
+    parser.error("the {} stage needs --output".format(args.stage))
+
+  with profiling.stage("csv"):
+    old_metadata = read_csv(args.input)
+  print("There are {} entries in the old metadata CSV.".format(len(old_metadata.keys())))
+
+  if args.stage in ["all", "measure"]:
+    measurements = measure(args, old_metadata)
+    if args.raw:
+      shard = "{}/{}".format(*args.shard) if args.shard else None
+      with profiling.stage("csv"):
+        append_raw_measurements(args.raw, measurements, shard)
+      print("Appended {} raw measurements to {}".format(len(measurements), args.raw))
+
+  if args.stage == "measure":
+    return
+
+  if args.stage == "merge":
+    darkness, width, angle, problems = merge_shards(args.shards)
+    if problems:
+      print ("".join(map("* {}\n".format, problems)))
+      sys.exit("Found {} problems while merging the shards! Aborting.".format(len(problems)))
+    unmeasured = [gfn for gfn in old_metadata.keys() if gfn not in darkness]
+    if unmeasured:
+      print("{} entries of the old metadata CSV were not measured by any shard.".format(len(unmeasured)))
+    if args.raw:
+      append_raw_measurements(args.raw, [(gfn, darkness[gfn], width[gfn], angle.get(gfn))
+                                         for gfn in darkness])
+  elif args.raw:
+    # normalize against every font ever measured,
+    # not just the ones measured in this run:
+    with profiling.stage("csv"):
+      darkness, width, angle = read_raw_measurements(args.raw)
+  else:
+    darkness = {gfn: d for gfn, d, _, _ in measurements}
+    width = {gfn: w for gfn, _, w, _ in measurements}
+    angle = {gfn: a for gfn, _, _, a in measurements}
+
+  if not darkness:
+    sys.exit("No raw measurements to normalize! Aborting.")
+
+  with profiling.stage("normalize"):
+    metadata = normalize_into(old_metadata, darkness, width, angle)
+  with profiling.stage("csv"):
     save_csv(args.output, metadata)
 
 
+def main():
+  args = parser.parse_args()
+
+  if len(sys.argv) < 2:
+    parser.print_help()
+    sys.exit(-1)
+
+  profiler = profiling.enable() if args.profile else None
+  try:
+    run(args)
+  finally:
+    if profiler is not None:
+      profiler.report(args.profile)
+
+
 if __name__ == "__main__":
   main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""Streaming discovery of font files.
+
+Instead of expanding every --files pattern into a list up front, the
+directory trees are walked with os.scandir on a background thread, and
+font files are handed over through a bounded queue as soon as they are
+found. Consumers can then resolve GFNs and render fonts while a slow
+(e.g. networked) checkout is still being enumerated.
+
+Patterns work like glob patterns (without "**"); a pattern naming a
+directory picks every font file below it. Only files with a font
+extension are returned, and each file only once, even when several
+patterns or symlinks lead to it.
+"""
+import fnmatch
+import glob
+import os
+import queue
+import threading
+
+FONT_EXTENSIONS = (".ttf", ".otf")
+DEFAULT_QUEUE_SIZE = 256
+
+
+def is_font_file(path):
+  return path.lower().endswith(FONT_EXTENSIONS)
+
+
+def _walk(directory):
+  """Yields every file below directory, recursively."""
+  try:
+    entries = list(os.scandir(directory))
+  except OSError:
+    return
+  for entry in sorted(entries, key=lambda e: e.name):
+    if entry.is_dir():
+      yield from _walk(entry.path)
+    elif entry.is_file():
+      yield entry.path
+
+
+def _match(directory, parts):
+  """Yields the paths below directory matching the remaining pattern
+     components, one directory level per component."""
+  part, rest = parts[0], parts[1:]
+  if not glob.has_magic(part):
+    path = os.path.join(directory, part)
+    if not rest:
+      if os.path.isfile(path):
+        yield path
+    elif os.path.isdir(path):
+      yield from _match(path, rest)
+    return
+
+  try:
+    entries = list(os.scandir(directory or os.curdir))
+  except OSError:
+    return
+  for entry in sorted(entries, key=lambda e: e.name):
+    # like glob, wildcards don't match hidden files:
+    if entry.name.startswith(".") and not part.startswith("."):
+      continue
+    if not fnmatch.fnmatch(entry.name, part):
+      continue
+    path = os.path.join(directory, entry.name)
+    if not rest:
+      if entry.is_file():
+        yield path
+    elif entry.is_dir():
+      yield from _match(path, rest)
+
+
+def _expand(pattern):
+  """Yields the files a single pattern refers to."""
+  pattern = os.path.expanduser(pattern)
+  if os.path.isdir(pattern):
+    yield from _walk(pattern)
+  elif os.path.isfile(pattern):
+    # (variable font names like "Family[wght].ttf" look like patterns)
+    yield pattern
+  elif glob.has_magic(pattern):
+    anchor, parts = "", pattern.split(os.sep)
+    if os.path.isabs(pattern):
+      anchor, parts = os.sep, parts[1:]
+    yield from _match(anchor, [part for part in parts if part])
+
+
+def iter_font_files(patterns):
+  """Yields the font files matched by a list of patterns, in the order
+     they are found, without duplicates."""
+  seen = set()
+  for pattern in patterns:
+    for path in _expand(pattern):
+      if not is_font_file(path):
+        continue
+      realpath = os.path.realpath(path)
+      if realpath in seen:
+        continue
+      seen.add(realpath)
+      yield path
+
+
+_DONE = object()
+
+
+def discover_font_files(patterns, maxsize=DEFAULT_QUEUE_SIZE):
+  """Like iter_font_files, but the directory walk runs on a background
+     thread, at most maxsize files ahead of the consumer."""
+  found = queue.Queue(maxsize)
+  stop = threading.Event()
+
+  def producer():
+    try:
+      for path in iter_font_files(patterns):
+        found.put(path)
+        if stop.is_set():
+          return
+    except Exception as e:
+      found.put(e)
+    found.put(_DONE)
+
+  thread = threading.Thread(target=producer, name="font-discovery")
+  thread.daemon = True
+  thread.start()
+  try:
+    while True:
+      item = found.get()
+      if item is _DONE:
+        break
+      if isinstance(item, Exception):
+        raise item
+      yield item
+  finally:
+    # the consumer may stop early; let the producer finish on its own:
+    stop.set()
+    while thread.is_alive():
+      try:
+        found.get(timeout=0.1)
+      except queue.Empty:
+        pass
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Write-behind persistence for edits made through the web tool.
+
+Every edit is appended to a journal file (and fsync'ed) before the
+request returns. A background thread periodically compacts the journal
+into the output CSV, which is replaced atomically, and then drops the
+journal entries that made it into the CSV. Entries left in the journal
+after a crash are replayed on the next startup.
+"""
+import json
+import os
+import threading
+import time
+
+
+def _truncate_torn_tail(path):
+  """Cuts a journal back to its last complete line, so that an entry
+     torn by a crash mid-write doesn't swallow the next one appended."""
+  if not os.path.exists(path):
+    return
+  with open(path, "r+b") as f:
+    data = f.read()
+    end = data.rfind(b"\n") + 1
+    if end < len(data):
+      f.truncate(end)
+      f.flush()
+      os.fsync(f.fileno())
+
+
+class EditJournal(object):
+  """Append-only log of (gfn, colname, newvalue) cell edits."""
+
+  def __init__(self, path):
+    self.path = path
+    self._lock = threading.Lock()
+    _truncate_torn_tail(path)
+    self._file = open(path, "ab")
+
+  def append(self, gfn, colname, newvalue):
+    line = json.dumps({"gfn": gfn, "colname": colname, "newvalue": newvalue})
+    with self._lock:
+      self._file.write(line.encode("utf-8") + b"\n")
+      self._file.flush()
+      os.fsync(self._file.fileno())
+
+  def size(self):
+    """Current length of the journal in bytes. Compaction uses it as a
+       marker of which entries have already been applied."""
+    with self._lock:
+      return self._file.tell()
+
+  def entries(self):
+    """Returns every complete entry in the journal, oldest first.
+       A torn last line (from a crash mid-write) is ignored."""
+    with self._lock:
+      with open(self.path, "rb") as f:
+        data = f.read()
+    entries = []
+    for line in data.split(b"\n"):
+      try:
+        entries.append(json.loads(line.decode("utf-8")))
+      except ValueError:
+        pass
+    return entries
+
+  def discard(self, upto):
+    """Drops the first `upto` bytes of the journal, keeping any entries
+       appended after that point."""
+    with self._lock:
+      with open(self.path, "rb") as f:
+        f.seek(upto)
+        remaining = f.read()
+      tmp = self.path + ".tmp"
+      with open(tmp, "wb") as f:
+        f.write(remaining)
+        f.flush()
+        os.fsync(f.fileno())
+      self._file.close()
+      os.replace(tmp, self.path)
+      self._file = open(self.path, "ab")
+
+  def close(self):
+    with self._lock:
+      self._file.close()
+
+
+def replay(entries, rows):
+  """Applies journal entries to a dict of gfn:values rows, in order.
+     Edits to the gfn column itself re-key the row."""
+  for entry in entries:
+    values = rows.get(entry["gfn"])
+    if values is None:
+      continue
+    values[entry["colname"]] = entry["newvalue"]
+    if entry["colname"] == "gfn":
+      rows[entry["newvalue"]] = rows.pop(entry["gfn"])
+
+
+class Compactor(threading.Thread):
+  """Background thread that folds the journal into the output CSV.
+
+  write_csv is called with a temporary filename while `lock` (the lock
+  guarding the in-memory rows) is held; it must write the whole CSV
+  there. Edits arriving within `delay` seconds of each other are
+  compacted together.
+  """
+
+  def __init__(self, journal, lock, write_csv, output, delay=1.0):
+    super(Compactor, self).__init__()
+    self.daemon = True
+    self.journal = journal
+    self.lock = lock
+    self.write_csv = write_csv
+    self.output = output
+    self.delay = delay
+    self._pending = threading.Event()
+
+  def schedule(self):
+    self._pending.set()
+
+  def compact(self):
+    tmp = self.output + ".tmp"
+    with self.lock:
+      applied = self.journal.size()
+      self.write_csv(tmp)
+    with open(tmp, "rb+") as f:
+      os.fsync(f.fileno())
+    os.replace(tmp, self.output)
+    self.journal.discard(applied)
+
+  def run(self):
+    while True:
+      self._pending.wait()
+      # give fast consecutive edits a chance to be written together:
+      time.sleep(self.delay)
+      self._pending.clear()
+      try:
+        self.compact()
+      except Exception as e:
+        # the edits stay in the journal, and the next edit tries again:
+        print ("Failed to save {}: {}: {}".format(self.output, type(e).__name__, e))
@@ -1,4 +1,4 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 # coding: utf-8
 # Copyright 2013 The Font Bakery Authors. All Rights Reserved.
 # Copyright 2017 The Google Font Tools Authors
@@ -26,22 +26,46 @@
 # font-classification-tool.py -h
 #
 import argparse
+import base64
 import collections
 import csv
-import glob
+import io
 import math
 import os
-import StringIO
 import sys
 import re
 import errno
+from urllib.parse import quote
+import profiling
 from fonts_public_pb2 import FamilyProto
 from constants import (NAMEID_FONT_FAMILY_NAME,
                        NAMEID_FONT_SUBFAMILY_NAME)
+from discovery import discover_font_files
 from gfn import GFN_from_filename
-
-import cairo
-from util import create_cairo_font_face_for_file, PycairoContext
+from edit_journal import (EditJournal,
+                          Compactor,
+                          replay)
+
+from util import (angle_score,
+                  append_raw_measurements,
+                  measure_font,
+                  normalize,
+                  read_csv,
+                  read_raw_measurements,
+                  require_cairo)
+from jobs import (JobItem,
+                  JobRunner,
+                  server_sent_events)
+from measurement_cache import MeasurementCache
+from supervised_pool import (DEFAULT_MEMORY_LIMIT,
+                             DEFAULT_TIMEOUT)
+from thumbnails import (ThumbnailCache,
+                        DEFAULT_THUMBNAIL_DIR)
+from sprites import SpriteAtlas
+from grid import (GridData,
+                  best_encoding,
+                  FILTER_COLUMNS,
+                  INT_COLUMNS)
 
 
 DESCRIPTION = """Calculates the visual weight, width or italic angle of fonts.
@@ -50,7 +74,8 @@ DESCRIPTION = """Calculates the visual weight, width or italic angle of fonts.
 
   For weight, it measures the darkness of a piece of text.
 
-  For italic angle it defaults to the italicAngle property of the font.
+  For italic angle it defaults to the italicAngle property of the font,
+  and italics that leave it at 0 get their slant estimated from the rendering.
 
   Then it starts a HTTP server and shows you the results, or
   if you pass --debug then it just prints the values.
@@ -61,7 +86,8 @@ DESCRIPTION = """Calculates the visual weight, width or italic angle of fonts.
 
 parser = argparse.ArgumentParser(description=DESCRIPTION)
 parser.add_argument("-f", "--files", default="*", required=True, nargs="+",
-                    help="The pattern to match for finding ttfs, eg 'folder_with_fonts/*.ttf'.")
+                    help="The patterns to match for finding ttfs, eg 'folder_with_fonts/*.ttf',"
+                         " or directories to search for font files.")
 parser.add_argument("-d", "--debug", default=False, action='store_true',
                     help="Debug mode, just print results")
 parser.add_argument("-e", "--existing", default=False,
@@ -70,6 +96,24 @@ parser.add_argument("-m", "--missingmetadata", default=False, action='store_true
                     help="Only process fonts for which metadata is not available yet")
 parser.add_argument("-o", "--output", default="output.csv", required=True,
                     help="CSV data output filename")
+parser.add_argument("-j", "--journal", default=None,
+                    help="Journal of unsaved edits (defaults to the output filename plus '.journal')")
+parser.add_argument("-t", "--thumbnails", default=DEFAULT_THUMBNAIL_DIR,
+                    help="Directory where rendered thumbnails are cached")
+parser.add_argument("-s", "--sprites", default=False, action='store_true',
+                    help="Pack all thumbnails into a few sprite sheets at startup")
+parser.add_argument("-w", "--workers", default=1, type=int,
+                    help="Number of worker processes used by measurement jobs (see /jobs)")
+parser.add_argument("-r", "--raw", default=None,
+                    help="Raw measurements file (see classify.py) that the fonts measured by jobs"
+                         " are appended to, and normalized against. Without it, jobs leave"
+                         " WEIGHT_INT and WIDTH_INT as they are")
+parser.add_argument("--no-cache", default=False, action='store_true',
+                    help="Neither read nor update the measurement cache in jobs")
+parser.add_argument("--profile", default=None, metavar="TRACE",
+                    help="Time the loading of the fonts and every rendered thumbnail, and on exit"
+                         " print the slowest stages and fonts and save a Chrome trace to TRACE."
+                         " The trace so far is also served at /profile.json")
 
 #TODO: make these available as CLI arguments as well:
 VERBOSE=True
@@ -77,8 +121,10 @@ VERBOSE=True
 
 try:
   from flask import (Flask,
+                     Response,
                      jsonify,
                      request,
+                     send_file,
                      send_from_directory)
 
 except:
@@ -142,121 +188,90 @@ def map_to_int_range(values, target_min=1, target_max=10):
   return integer_values
 
 
-def get_angle(ttfont):
-  """Returns the italic angle, given a filename of a TTF"""
-  return ttfont['post'].italicAngle
-
-
-
-FONT_SIZE=30
-# The text used to test weight and width. Note that this could be
-# problematic if a given font doesn't have latin support.
-LATIN_TEXT = "AaBbCcDdEeFfGgHhIiJjKkLlMmNnOoPpQqRrSsTtUuVvXxYyZz"
-KHMER_TEXT = "\xE1\x9E\x9A\xE1\x9E\x9B\xE1\x9E\x80\xE1\x9E\x94\xE1\x9E\x80\xE1\x9F\x8B\xE1\x9E\x94\xE1\x9F\x84\xE1\x9E\x80\xE1\x9E\x93\xE1\x9E\xB6\xE1\x9E\x9B\xE1\x9F\x92\xE1\x9E\x84\xE1\x9E\xB6\xE1\x9E\x85\xE1\x9E\x8A\xE1\x9F\x8F\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x84\xE1\x9E\x85\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x82\xE1\x9E\x84"
-
-
-img_counter=0
-def render_single_line(fontfile, khmer=False):
-  global img_counter
-
-  if khmer:
-    sample_text = KHMER_TEXT
-  else:
-    sample_text = LATIN_TEXT
-
-  face = create_cairo_font_face_for_file(fontfile, 0)
-
-  #dummy surface
-  surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 0, 0)
-  ctx = cairo.Context(surface)
-  ctx.set_font_face(face)
-  ctx.set_font_size(30)
-  extents = ctx.text_extents(sample_text)
-#  print extents
-  xbearing, ybearing, width, height, _, _ = extents
-
-
-  #actual surface
-  surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(width), int(height))
-  ctx = cairo.Context(surface)
+def thumbnail_html(gfn, fontfile):
+  """HTML for displaying the sample line of a font. The image itself
+     is only rendered once the browser asks for it (see /thumb/)."""
+  # the version parameter lets browsers cache the image for as long as
+  # the font file stays the same:
+  url = "/thumb/{}?v={}".format(quote(gfn), int(os.path.getmtime(fontfile)))
+  return "<img class='thumb' height='50%' src='{}' />".format(url)
 
-  ctx.set_font_face(face)
-  ctx.set_font_size(30)
-  ctx.move_to(-xbearing, -ybearing)
-  ctx.show_text(sample_text)
 
-  del ctx
-
-  img_counter += 1
-  try:
-    surface.write_to_png("font_classification_tool/images/{}.png".format(img_counter))
-    return "<img height='50%%' src='font_classification_tool/images/{}.png' />".format(img_counter)
-  except:
-    print ("Cairo failed to write PNG file for {}".format(fontfile))
-    return ""
+def sprite_html(offset):
+  """HTML for displaying the sample line of a font from a sprite sheet.
+     The outer span is there to carry the italic angle background."""
+  return ("<span class='thumb' style='display:inline-block'>"
+          "<span style='display:inline-block; width:{w}px; height:{h}px;"
+          " background:url(/sprites/{sheet}) -{x}px -{y}px no-repeat'></span>"
+          "</span>").format(**offset)
 
 def get_base64_image(img):
   """Get the base 64 representation of an image,
      to use for visual testing."""
-  output = StringIO.StringIO()
+  output = io.BytesIO()
   img.save(output, "PNG")
-  base64img = output.getvalue().encode("base64")
+  base64img = base64.b64encode(output.getvalue())
   output.close()
   return base64img
 
 
 
-def main():
-  args = parser.parse_args()
-
-  if len(sys.argv) < 2:
-    parser.print_help()
-    sys.exit(-1)
-
-  files_to_process = []
-  for pattern in args.files:
-    files_to_process.extend(glob.glob(pattern))
-
-  if len(files_to_process) == 0:
-    sys.exit("No font files were found!")
-
+def create_app(args):
+  """Loads the fonts and metadata selected by the command line arguments
+     and returns the Flask app serving them."""
   fontinfo = {}
   # start with the existing values:
   if args.existing:
-    with open(args.existing) as csvfile:
-        existing_data = csv.reader(csvfile, delimiter=',', quotechar='"')
-        next(existing_data) # skip first row as its not data
-        for row in existing_data:
-          gfn = row[0]
-          fontinfo[gfn] = {
-            "weight_int": int(row[1]),
-            "angle_int": int(row[2]),
-            "width_int": int(row[3]),
-            "usage": row[4],
-            "subsets": row[5],
-            "gfn": gfn,
-            "img_weight": None
-          }
-
-  for fname in files_to_process:
-    gfn = GFN_from_filename(fname)
+    with profiling.stage("csv"):
+      existing = read_csv(args.existing)
+    for gfn, row in existing.items():
+      fontinfo[gfn] = dict(row.items(), gfn=gfn, img_weight=None)
+
+  thumbnail_fonts = {}
+  found = 0
+  # GFNs get resolved while the font directories are still being walked:
+  for fname in discover_font_files(args.files):
+    found += 1
+    with profiling.stage("gfn", fname):
+      gfn = GFN_from_filename(fname)
     if gfn in fontinfo.keys():
-      fontinfo[gfn]['img_weight'] = render_single_line(fname, "khmer" in fontinfo[gfn]['subsets'])
-      # TODO: fontinfo[gfn]["weight"]
-      # TODO: "width" = width
-      # TODO: "angle" = angle
+      fontinfo[gfn]['fontfile'] = fname
+      fontinfo[gfn]['img_weight'] = thumbnail_html(gfn, fname)
+      thumbnail_fonts[gfn] = fontinfo[gfn]
+
+  if found == 0:
+    sys.exit("No font files were found!")
 
-  # analyse_fonts(files_to_process)
+  atlas = None
+  sprite_offsets = {}
+  if args.sprites:
+    def measure(gfn, render):
+      values = thumbnail_fonts[gfn]
+      values['weight'], values['width'], values['angle'] = \
+        measure_font(values['fontfile'], values['subsets'], render=render)
+
+    atlas = SpriteAtlas(os.path.join(args.thumbnails, "sprites"))
+    sprite_offsets = atlas.build([(gfn, values['fontfile'], values['subsets'])
+                                  for gfn, values in sorted(thumbnail_fonts.items())],
+                                 on_render=measure)
+    for gfn, offset in sprite_offsets.items():
+      thumbnail_fonts[gfn]['img_weight'] = sprite_html(offset)
 
   if fontinfo == {}:
     sys.exit("All specified fonts are blacklisted!")
 
+  # apply edits that didn't make it into the output CSV last time:
+  journal = EditJournal(args.journal or args.output + ".journal")
+  unapplied = journal.entries()
+  if unapplied:
+    print ("Replaying {} unsaved edits from {}".format(len(unapplied), journal.path))
+    replay(unapplied, fontinfo)
+
 
 
   # generate data for the web server
   # double(<unit>, <precision>, <decimal_point>, <thousands_separator>, <show_unit_before_number>, <nansymbol>)
-  grid_data = {
-    "metadata": [
+  grid_metadata = [
       {"name":"fontfile","label":"filename","datatype":"string","editable":True},
       {"name":"gfn","label":"GFN","datatype":"string","editable":True},
       {"name":"weight","label":"weight","datatype":"double(, 2, dot, comma, 0, n/a)","editable":True},
@@ -269,12 +284,9 @@ def main():
       {"name":"angle","label":"angle","datatype":"double(, 2, dot, comma, 0, n/a)","editable":True},
       {"name":"angle_int","label":"ANGLE_INT","datatype":"integer","editable":True},
       {"name":"image","label":"image","datatype":"html","editable":False},
-    ],
-    "data": []
-  }
+  ]
   #generate_italic_angle_images()
 
-  field_id = 1
   for key in fontinfo:
     values = fontinfo[key]
     img_weight_html = ""
@@ -283,15 +295,20 @@ def main():
     #  img_weight_html = "<img height='50%%' src='data:image/png;base64,%s' />" % (values["img_weight"])
 
     values["image"] = img_weight_html
-    grid_data["data"].append({"id": field_id, "values": values})
-    field_id += 1
 
-  def save_csv():
-    filename = args.output
+  grid = GridData(grid_metadata, list(fontinfo.values()))
+
+  # thumbnail URLs use the GFNs from before replaying the journal,
+  # so map them to row ids through the (shared) values dicts:
+  rowid_of_values = {id(row['values']): row['id'] for row in grid.rows}
+  thumbnail_rowids = {gfn: rowid_of_values[id(values)]
+                      for gfn, values in thumbnail_fonts.items()}
+
+  def save_csv(filename):
     with open(filename, 'w') as csvfile:
         writer = csv.writer(csvfile, delimiter=',', quotechar='"', lineterminator='\n')
         writer.writerow(["GFN","FWE","FIA","FWI","USAGE"]) # first row has the headers
-        for data in sorted(grid_data['data'], key=lambda d: d['values']['gfn']):
+        for data in sorted(grid.rows, key=lambda d: d['values']['gfn']):
           values = data['values']
           gfn = values['gfn']
           fwe = values['weight_int']
@@ -299,30 +316,206 @@ def main():
           fwi = values['width_int']
           usage = values['usage']
           writer.writerow([gfn, fwe, fia, fwi, usage])
-    return 'ok'
+
+  compactor = Compactor(journal, grid.lock, save_csv, args.output)
+  if unapplied:
+    compactor.compact()
+  compactor.start()
+
+  # raw values that jobs normalize their measurements against:
+  raw_darkness, raw_width = {}, {}
+  if args.raw and os.path.exists(args.raw):
+    raw_darkness, raw_width, _ = read_raw_measurements(args.raw)
+
+  def store_measurement(item, darkness, width, angle, error):
+    """Puts the measurement of a font by a job into the grid (and the
+       journal, for the scores), and returns the data of its event."""
+    event = {"gfn": item.gfn, "rowid": item.rowid, "error": error}
+    if error is not None:
+      print ("Failed to measure {} ({}): {}".format(item.fontfile, item.gfn, error))
+      return event
+    changes = {'weight': darkness, 'width': width, 'angle': angle,
+               'angle_int': angle_score(angle)}
+    with grid.lock:
+      row = grid.rows_by_id.get(item.rowid)
+      if row is None:
+        return event
+      gfn = row['values']['gfn']
+      if args.raw:
+        append_raw_measurements(args.raw, [(gfn, darkness, width, angle)])
+        raw_darkness[gfn], raw_width[gfn] = darkness, width
+        changes['weight_int'] = normalize(raw_darkness)[gfn]
+        changes['width_int'] = normalize(raw_width)[gfn]
+      for colname in INT_COLUMNS:
+        if colname in changes:
+          journal.append(gfn, colname, changes[colname])
+      grid.update(item.rowid, changes)
+    compactor.schedule()
+    event.update(changes, gfn=gfn)
+    return event
+
+  runner = JobRunner(store_measurement, args.workers, DEFAULT_TIMEOUT, DEFAULT_MEMORY_LIMIT,
+                     cache=None if args.no_cache else MeasurementCache)
+  runner.start()
 
   app = Flask(__name__)
   @app.route('/font_classification_tool/<path:path>')
   def send_the_files(path):
-    print (path)
     if path == 'index.html' or path.endswith('.js'):
       return send_from_directory(os.path.dirname(__file__) + '/font_classification_tool/', path)
     else:
       return send_from_directory(os.path.dirname(__file__), path)
 
+  thumbnails = ThumbnailCache(args.thumbnails)
+
+  @app.route('/thumb/<path:gfn>')
+  def thumbnail(gfn):
+    values = thumbnail_fonts.get(gfn)
+    if values is None:
+      return 'unknown font', 404
+    fontfile = values['fontfile']
+    path, render = thumbnails.get(fontfile, values['subsets'])
+    if render is not None:
+      # the font had to be rasterized anyway,
+      # so take its measurements as well:
+      try:
+        weight, width, angle = measure_font(fontfile, values['subsets'], render=render)
+      except Exception as e:
+        # (eg fonts with no ink, or no x) the thumbnail is fine anyway
+        print ("Failed to measure {}: {}".format(fontfile, e))
+      else:
+        grid.annotate(thumbnail_rowids[gfn], {'weight': weight, 'width': width, 'angle': angle})
+    response = send_file(path, mimetype='image/png')
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    return response
+
+  @app.route('/sprites/<name>')
+  def sprite_sheet(name):
+    if atlas is None:
+      return 'sprites are disabled', 404
+    response = send_from_directory(atlas.cachedir, name, mimetype='image/png')
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 3600
+    return response
+
+  @app.route('/sprites.json')
+  def sprite_map():
+    return jsonify(sprite_offsets)
+
+  @app.route('/profile.json')
+  def profile():
+    profiler = profiling.active()
+    if profiler is None:
+      return 'profiling is disabled, see --profile', 404
+    return jsonify(profiler.chrome_trace())
+
   @app.route('/data.json')
   def json_data():
-    return jsonify(grid_data)
+    since = request.args.get('since')
+    if since is not None:
+      # only the rows edited after the client's version:
+      try:
+        return Response(grid.delta(since), mimetype='application/json')
+      except ValueError as e:
+        # from before a restart: the client has to load everything again
+        return str(e), 409
+
+    with grid.lock:
+      etag = grid.etag()
+      if request.if_none_match.contains(etag):
+        response = Response(status=304)
+      else:
+        encoding = best_encoding(request.headers.get('Accept-Encoding'))
+        response = Response(grid.payload(encoding), mimetype='application/json')
+        if encoding is not None:
+          response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.cache_control.no_cache = True
+    return response
+
+  @app.route('/query.json')
+  def query():
+    filters = {}
+    try:
+      for column in FILTER_COLUMNS + ["subsets"]:
+        if column in request.args:
+          accepted = request.args[column].split(",")
+          if column in INT_COLUMNS:
+            accepted = [int(v) for v in accepted]
+          filters[column] = accepted
+      result = grid.query(page=request.args.get('page', 0, type=int),
+                          page_size=request.args.get('page_size', 50, type=int),
+                          sort=request.args.get('sort', 'gfn'),
+                          descending=request.args.get('order') == 'desc',
+                          filters=filters,
+                          gfn=request.args.get('gfn'))
+    except ValueError as e:
+      return str(e), 400
+    return jsonify(result)
+
+  @app.route('/jobs', methods=['POST'])
+  def start_job():
+    """Starts measuring the rows of the GFNs posted as a JSON
+       {"gfns": [...]} body (or as gfn form fields)."""
+    selection = request.get_json(silent=True) or {}
+    wanted = set(selection.get('gfns') or request.form.getlist('gfn'))
+    if not wanted:
+      return 'no GFNs selected', 400
+    with grid.lock:
+      items = [JobItem(row['values']['gfn'], row['id'],
+                       row['values']['fontfile'], row['values']['subsets'])
+               for row in grid.rows
+               if row['values']['gfn'] in wanted and row['values'].get('fontfile')]
+    if not items:
+      return 'none of the selected GFNs has a font file', 404
+    job = runner.submit(items)
+    status = job.status()
+    # GFNs without a font file can't be measured:
+    status['skipped'] = sorted(wanted - set(item.gfn for item in items))
+    response = jsonify(status)
+    response.status_code = 202
+    response.headers['Location'] = '/jobs/' + job.id
+    return response
+
+  @app.route('/jobs/<jobid>', methods=['GET', 'DELETE'])
+  def job_status(jobid):
+    job = runner.get(jobid)
+    if job is None:
+      return 'unknown job', 404
+    if request.method == 'DELETE':
+      job.cancel()
+    return jsonify(job.status())
+
+  @app.route('/jobs/<jobid>/events')
+  def job_events(jobid):
+    job = runner.get(jobid)
+    if job is None:
+      return 'unknown job', 404
+    # reconnecting clients resume after the last event they got:
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+      since = request.args.get('since', 0, type=int)
+    response = Response(server_sent_events(job, since), mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
   @app.route('/update', methods=['POST'])
   def update():
     rowid = request.form['id']
     newvalue = request.form['newvalue']
     colname = request.form['colname']
-    for row in grid_data["data"]:
-      if row['id'] == int(rowid):
-        row['values'][colname] = newvalue
-    return save_csv()
+    with grid.lock:
+      row = grid.rows_by_id.get(int(rowid))
+      if row is None:
+        return 'unknown row', 404
+      journal.append(row['values']['gfn'], colname, newvalue)
+      grid.update(int(rowid), {colname: newvalue})
+    # the CSV itself gets rewritten later, in the background:
+    compactor.schedule()
+    return 'ok'
 
 #  if blacklisted:
 #    print ("{} blacklisted font files:\n".format(len(blacklisted)))
@@ -332,8 +525,25 @@ def main():
 #    print ("Failed to detect weight(darkness value) for {} of the font files:\n".format(len(bad_darkness)))
 #    print ("".join(map("* {}\n".format, bad_darkness)))
 
-  print ("\n\nAccess http://127.0.0.1:5000/font_classification_tool/index.html\n")
-  app.run()
+  return app
+
+
+def main():
+  args = parser.parse_args()
+
+  if len(sys.argv) < 2:
+    parser.print_help()
+    sys.exit(-1)
+
+  require_cairo()
+  profiler = profiling.enable() if args.profile else None
+  try:
+    app = create_app(args)
+    print ("\n\nAccess http://127.0.0.1:5000/font_classification_tool/index.html\n")
+    app.run()
+  finally:
+    if profiler is not None:
+      profiler.report(args.profile)
 
 
 if __name__ == "__main__":
@@ -24,6 +24,10 @@
 import os
 import sys
 import collections
+import errno
+import glob
+import json
+import re
 from fonts_public_pb2 import FamilyProto
 from constants import (NAMEID_FONT_FAMILY_NAME,
                        NAMEID_FONT_SUBFAMILY_NAME)
@@ -145,9 +149,9 @@ def _FileFamilyStyleWeights(fontdir):
     raise OSError(errno.ENOENT, 'no font files found')
 
   result = [FileFamilyStyleWeight(f) for f in files]
-  def _Cmp(r1, r2):
-    return cmp(r1.weight, r2.weight) or -cmp(r1.style, r2.style)
-  result = sorted(result, _Cmp)
+  # by weight, then style in reverse alphabetical order (normal first):
+  result = sorted(result, key=lambda r: r.style, reverse=True)
+  result = sorted(result, key=lambda r: r.weight)
 
   family_names = {i.family for i in result}
   if len(family_names) > 1:
@@ -157,62 +161,192 @@ def _FileFamilyStyleWeights(fontdir):
   return result
 
 
-def GFN_from_filename(fontfile):
-  ttfont = TTFont(fontfile)
+VERBOSE = False
 
-  gfn = "unknown"
-  fontdir = os.path.dirname(fontfile)
-  metadata = os.path.join(fontdir, "METADATA.pb")
-  if os.path.exists(metadata):
-    family = get_FamilyProto_Message(metadata)
+# Known misspellings of family names and their fixed spellings.
+_GFN_EXCEPTIONS = [
+  ("Bio Rhyme", "BioRhyme"),
+]
+
+
+def _name_string(entry):
+  """Returns a name table entry as a plain ASCII string."""
+  return entry.toUnicode().encode('ascii', 'ignore').decode('ascii').strip()
+
+
+class GFNResolver(object):
+  """Resolves the GFN of font files.
+
+  A family's METADATA.pb is parsed only once, no matter how many of its
+  font files are resolved, and the font binary itself is only opened
+  (reading nothing but its name table) when the GFN can't be determined
+  from the metadata or the filename.
+  """
+
+  def __init__(self):
+    self._family_protos = {}
+    self._filename_gfns = {}
+
+  def family_proto(self, fontdir):
+    """Returns the parsed METADATA.pb of fontdir, or None if it has none."""
+    fontdir = os.path.abspath(fontdir)
+    if fontdir not in self._family_protos:
+      metadata = os.path.join(fontdir, "METADATA.pb")
+      if os.path.exists(metadata):
+        self._family_protos[fontdir] = get_FamilyProto_Message(metadata)
+      else:
+        self._family_protos[fontdir] = None
+    return self._family_protos[fontdir]
+
+  def filename_gfns(self, fontdir):
+    """Returns a dict mapping the basename of every font file in fontdir
+       to a GFN derived from its filename, scanning the directory only once.
+       The dict is empty if the filenames can't be parsed."""
+    fontdir = os.path.abspath(fontdir)
+    if fontdir not in self._filename_gfns:
+      gfns = {}
+      try:
+        for (fontfname, family, style, weight) in _FileFamilyStyleWeights(fontdir):
+          gfns[os.path.basename(fontfname)] = "{}:{}:{}".format(family, style, weight)
+      except:
+        gfns = {}
+      self._filename_gfns[fontdir] = gfns
+    return self._filename_gfns[fontdir]
+
+  def clear(self):
+    """Forgets everything memoized so far."""
+    self._family_protos.clear()
+    self._filename_gfns.clear()
+
+  def _from_metadata(self, fontfile, family):
     for font in family.fonts:
       if font.filename in fontfile:
-        gfn = "{}:{}:{}".format(family.name, font.style, font.weight)
-        break
-  else:
-    try:
-      attributes = _FileFamilyStyleWeights(fontdir)
-      for (fontfname, family, style, weight) in attributes:
-        if fontfname in fontfile:
-          gfn = "{}:{}:{}".format(family, style, weight)
-          break
-    except:
-      pass
+        return "{}:{}:{}".format(family.name, font.style, font.weight)
+    return "unknown"
 
-  if gfn == 'unknown':
-    #This font lacks a METADATA.pb file and also failed
-    # to auto-detect the GFN value. As a last resort
-    # we'll try to extract the info from the NAME table entries.
+  def _from_filename(self, fontfile):
+    gfns = self.filename_gfns(os.path.dirname(fontfile))
+    return gfns.get(os.path.basename(fontfile), "unknown")
+
+  def _from_name_table(self, fontfile):
+    family = ""
     try:
-      for entry in ttfont['name'].names:
-        if entry.nameID == NAMEID_FONT_FAMILY_NAME:
-          family = entry.string.decode(entry.getEncoding()).encode('ascii', 'ignore').strip()
-        if entry.nameID == NAMEID_FONT_SUBFAMILY_NAME:
-          style, weight = StyleWeight(entry.string.decode(entry.getEncoding()).encode('ascii', 'ignore').strip())
-      ttfont.close()
+      ttfont = TTFont(fontfile, lazy=True)
+      try:
+        for entry in ttfont['name'].names:
+          if entry.nameID == NAMEID_FONT_FAMILY_NAME:
+            family = _name_string(entry)
+          if entry.nameID == NAMEID_FONT_SUBFAMILY_NAME:
+            style, weight = StyleWeight(_name_string(entry))
+      finally:
+        ttfont.close()
       if family != "": #avoid empty string in cases of misbehaved family names in the name table
         gfn = "{}:{}:{}".format(family, style, weight)
         if VERBOSE:
           print ("Detected GFN from name table entries: '{}' (file='{}')".format(gfn, fontfile))
+        return gfn
     except:
       # print("This seems to be a really bad font file... ({})".format(fontfile))
       pass
+    return "unknown"
+
+  def resolve(self, fontfile):
+    family = self.family_proto(os.path.dirname(fontfile))
+    if family is not None:
+      gfn = self._from_metadata(fontfile, family)
+    else:
+      gfn = self._from_filename(fontfile)
+
+    if gfn == 'unknown':
+      #This font lacks a METADATA.pb file and also failed
+      # to auto-detect the GFN value. As a last resort
+      # we'll try to extract the info from the NAME table entries.
+      gfn = self._from_name_table(fontfile)
+
+    #if gfn == 'unknown':
+    #  print ("Failed to detect GFN value for '{}'. Defaults to 'unknown'.".format(fontfile))
+
+    for bad, good in _GFN_EXCEPTIONS:
+      if bad in gfn:
+        gfn = good.join(gfn.split(bad))
+
+    return gfn
 
-  #if gfn == 'unknown':
-  #  print ("Failed to detect GFN value for '{}'. Defaults to 'unknown'.".format(fontfile))
+  def resolve_family(self, fontdir):
+    """Returns a dict mapping every font file in fontdir to its GFN."""
+    fontfiles = sorted(glob.glob(os.path.join(fontdir, '*.ttf')))
+    return {fontfile: self.resolve(fontfile) for fontfile in fontfiles}
 
-  exceptions = [
-    ("Bio Rhyme", "BioRhyme"),
-  ]
 
-  for bad, good in exceptions:
-    if bad in gfn:
-      gfn = good.join(gfn.split(bad))
+_default_resolver = GFNResolver()
 
-  return gfn
+def GFN_from_filename(fontfile, resolver=None):
+  """Returns the GFN of a font file, using the shared resolver unless
+     another one is given."""
+  if resolver is None:
+    resolver = _default_resolver
+  return resolver.resolve(fontfile)
 
-def GFNs_from_filenames(filenames):
-  return {fname: GFN_from_filename(fname) for fname in filenames}
+
+class GFNIndex(object):
+  """Maps font file paths to GFNs, resolving each path only once.
+
+  The index can optionally be persisted to a JSON file. Persisted entries
+  are reused as long as the font file's mtime and size, and the mtime of
+  its family's METADATA.pb, are unchanged.
+  """
+
+  def __init__(self, path=None, resolver=None):
+    if resolver is None:
+      resolver = _default_resolver
+    self.path = path
+    self.resolver = resolver
+    self._gfns = {}   # resolved during this run
+    self._stored = {} # loaded from disk, not yet validated
+    if path is not None and os.path.exists(path):
+      with open(path) as f:
+        self._stored = json.load(f)
+
+  @staticmethod
+  def _stamp(fontfile):
+    st = os.stat(fontfile)
+    metadata = os.path.join(os.path.dirname(fontfile), "METADATA.pb")
+    metadata_mtime = os.stat(metadata).st_mtime if os.path.exists(metadata) else None
+    return [st.st_mtime, st.st_size, metadata_mtime]
+
+  def __getitem__(self, fontfile):
+    key = os.path.abspath(fontfile)
+    if key not in self._gfns:
+      stamp = self._stamp(fontfile)
+      stored = self._stored.pop(key, None)
+      if stored is not None and stored["stamp"] == stamp:
+        self._gfns[key] = (stored["gfn"], stamp)
+      else:
+        self._gfns[key] = (GFN_from_filename(fontfile, self.resolver), stamp)
+    return self._gfns[key][0]
+
+  def __contains__(self, fontfile):
+    return os.path.abspath(fontfile) in self._gfns
+
+  def __len__(self):
+    return len(self._gfns)
+
+  def save(self, path=None):
+    """Writes every entry resolved during this run to disk."""
+    if path is None:
+      path = self.path
+    entries = {key: {"gfn": gfn, "stamp": stamp}
+               for key, (gfn, stamp) in self._gfns.items()}
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+      json.dump(entries, f, indent=0, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def GFNs_from_filenames(filenames, index=None):
+  if index is None:
+    index = GFNIndex()
+  return {fname: index[fname] for fname in filenames}
 
 
 def get_GFNs_from_gfonts(apikey):
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+"""In-memory state of the classification grid served by the web tool.
+
+Rows are indexed by id, and every change bumps a version counter. The
+serialized /data.json payload (plain, gzip and brotli) is computed once
+per version, and the version doubles as its ETag. Versions given out to
+clients are prefixed with a token of the server process ("<token>-<n>"),
+since counting starts over on every server start. Values annotated on the
+side (see annotate) bump a sub-version instead ("<token>-<n>.<m>").
+
+For server-side paging, every sortable column has a sorted index of
+(sort key, row id) pairs, and the filterable columns have value -> row ids
+indexes. Both are kept up to date by update(), so a query only has to
+look at the rows of the page it returns.
+"""
+import bisect
+import gzip
+import json
+import threading
+import uuid
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+
+# Columns holding integer scores; values posted by the grid are strings.
+INT_COLUMNS = ["weight_int", "width_int", "angle_int"]
+SORT_COLUMNS = ["gfn", "weight", "weight_int", "width", "width_int",
+                "angle", "angle_int", "usage"]
+# Columns that can be filtered by exact value:
+FILTER_COLUMNS = INT_COLUMNS + ["usage"]
+# Largest page query() returns; bigger page sizes are cut down to it.
+MAX_PAGE_SIZE = 500
+
+
+def _sort_key(value):
+  """Orders numbers before strings and empty values last, so columns
+     with mixed or missing values can still be sorted."""
+  if value is None or value == "":
+    return (2, 0.0, "")
+  try:
+    return (0, float(value), "")
+  except (TypeError, ValueError):
+    return (1, 0.0, str(value))
+
+
+def _coerce_ints(values):
+  """Turns the INT_COLUMNS of a values dict into ints, in place: values
+     posted by the grid (or replayed from the journal) are strings."""
+  for column in INT_COLUMNS:
+    if column in values:
+      try:
+        values[column] = int(values[column])
+      except (TypeError, ValueError):
+        pass
+
+
+def _subsets(values):
+  return (values.get("subsets") or "").split("+")
+
+
+class GridData(object):
+
+  def __init__(self, metadata, rows):
+    """metadata is the EditableGrid column description and rows a list
+       of values dicts. Rows get ids from 1 onwards, in the given order."""
+    self.metadata = metadata
+    self.rows = [{"id": rowid, "values": values}
+                 for rowid, values in enumerate(rows, 1)]
+    for row in self.rows:
+      _coerce_ints(row["values"])
+    self.rows_by_id = {row["id"]: row for row in self.rows}
+    self.lock = threading.RLock()
+    self.token = uuid.uuid4().hex[:12]
+    self.version = 0
+    # annotations since the last update:
+    self.subversion = 0
+    # rowid:(version, subversion) of its last change
+    self._row_versions = {row["id"]: (0, 0) for row in self.rows}
+    self._payloads = {}
+
+    self._sort_indexes = {}
+    for column in SORT_COLUMNS:
+      self._sort_indexes[column] = sorted(
+        (_sort_key(row["values"].get(column)), row["id"]) for row in self.rows)
+
+    self._filter_indexes = {column: {} for column in FILTER_COLUMNS}
+    self._subset_index = {}
+    for row in self.rows:
+      self._index_filters(row)
+
+  def _index_filters(self, row, remove=False):
+    """Adds a row to (or removes it from) the filter indexes."""
+    values = row["values"]
+    entries = [(self._filter_indexes[column], values.get(column))
+               for column in FILTER_COLUMNS]
+    entries += [(self._subset_index, subset) for subset in _subsets(values)]
+    for index, value in entries:
+      if remove:
+        index[value].discard(row["id"])
+      else:
+        index.setdefault(value, set()).add(row["id"])
+
+  def update(self, rowid, changes):
+    """Applies a dict of colname:value changes to a row and returns the
+       row, or None if there's no such row."""
+    with self.lock:
+      row = self._apply(rowid, changes)
+      if row is None:
+        return None
+      self.version += 1
+      self.subversion = 0
+      self._row_versions[rowid] = (self.version, 0)
+      self._payloads.clear()
+      return row
+
+  def annotate(self, rowid, changes):
+    """Like update(), for values computed on the side (eg the raw
+       measurements taken while rendering thumbnails) rather than edits:
+       only the sub-version gets bumped. They can't change the filter
+       columns."""
+    if any(column in FILTER_COLUMNS for column in changes):
+      raise ValueError("Filter columns can only be changed by update()")
+    with self.lock:
+      row = self._apply(rowid, changes)
+      if row is None:
+        return None
+      self.subversion += 1
+      self._row_versions[rowid] = (self.version, self.subversion)
+      self._payloads.clear()
+      return row
+
+  def _apply(self, rowid, changes):
+    """Changes a row and its indexes; the caller holds the lock."""
+    row = self.rows_by_id.get(rowid)
+    if row is None:
+      return None
+    changes = dict(changes)
+    _coerce_ints(changes)
+
+    self._index_filters(row, remove=True)
+    for column in SORT_COLUMNS:
+      if column in changes:
+        index = self._sort_indexes[column]
+        old_entry = (_sort_key(row["values"].get(column)), rowid)
+        del index[bisect.bisect_left(index, old_entry)]
+        bisect.insort(index, (_sort_key(changes[column]), rowid))
+    row["values"].update(changes)
+    self._index_filters(row)
+    return row
+
+  def tag(self):
+    """The current version as given out to clients."""
+    if self.subversion:
+      return "{}-{}.{}".format(self.token, self.version, self.subversion)
+    return "{}-{}".format(self.token, self.version)
+
+  def parse_tag(self, tag):
+    """Returns the (version, subversion) of a tag given out by tag().
+       Raises ValueError for malformed tags and for those of another
+       server process."""
+    token, _, version = tag.rpartition("-")
+    if token != self.token:
+      raise ValueError("'{}' is not a version of this server".format(tag))
+    version, _, subversion = version.partition(".")
+    return int(version), int(subversion or 0)
+
+  def etag(self):
+    """The (unquoted) entity tag of the current payload."""
+    return self.tag()
+
+  def payload(self, encoding=None):
+    """Returns the whole grid serialized as JSON, compressed with the
+       given encoding ("gzip", "br" or None)."""
+    with self.lock:
+      if encoding not in self._payloads:
+        if encoding is None:
+          body = json.dumps({"metadata": self.metadata,
+                             "data": self.rows,
+                             "version": self.tag()}).encode("utf-8")
+        elif encoding == "gzip":
+          body = gzip.compress(self.payload(), 6)
+        elif encoding == "br":
+          body = brotli.compress(self.payload())
+        else:
+          raise ValueError("Unsupported encoding: {}".format(encoding))
+        self._payloads[encoding] = body
+      return self._payloads[encoding]
+
+  def delta(self, since):
+    """Returns the rows changed after the version tagged `since`,
+       serialized as JSON. Raises ValueError if since isn't a tag of
+       this server (see parse_tag): clients then need the whole payload."""
+    since = self.parse_tag(since)
+    with self.lock:
+      changed = [self.rows_by_id[rowid]
+                 for rowid, version in sorted(self._row_versions.items())
+                 if version > since]
+      return json.dumps({"data": changed,
+                         "version": self.tag()}).encode("utf-8")
+
+
+  def query(self, page=0, page_size=50, sort="gfn", descending=False,
+            filters=None, gfn=None):
+    """Returns one page of rows, in the order of a sort column.
+
+       filters maps FILTER_COLUMNS names (and "subsets") to lists of
+       accepted values; gfn, if given, is a case-insensitive substring
+       the GFNs must contain. The result is a dict with the rows of the
+       page and the total number of matching rows. page_size is capped
+       at MAX_PAGE_SIZE.
+    """
+    if sort not in SORT_COLUMNS:
+      raise ValueError("Can't sort by {}".format(sort))
+    if page < 0:
+      raise ValueError("Invalid page: {}".format(page))
+    if page_size < 1:
+      raise ValueError("Invalid page size: {}".format(page_size))
+    page_size = min(page_size, MAX_PAGE_SIZE)
+
+    with self.lock:
+      candidates = None
+      for column, accepted in (filters or {}).items():
+        if column == "subsets":
+          index = self._subset_index
+        else:
+          index = self._filter_indexes[column]
+        matches = set()
+        for value in accepted:
+          matches |= index.get(value, set())
+        candidates = matches if candidates is None else candidates & matches
+
+      if gfn:
+        needle = gfn.lower()
+        if candidates is None:
+          candidates = set(self.rows_by_id)
+        candidates = {rowid for rowid in candidates
+                      if needle in self.rows_by_id[rowid]["values"]["gfn"].lower()}
+
+      order = self._sort_indexes[sort]
+      start = page * page_size
+      if candidates is None:
+        total = len(order)
+        if descending:
+          page_entries = order[::-1][start:start + page_size]
+        else:
+          page_entries = order[start:start + page_size]
+        rows = [self.rows_by_id[rowid] for _, rowid in page_entries]
+      else:
+        total = len(candidates)
+        rows = []
+        seen = 0
+        for _, rowid in (reversed(order) if descending else order):
+          if rowid not in candidates:
+            continue
+          if seen >= start:
+            rows.append(self.rows_by_id[rowid])
+            if len(rows) == page_size:
+              break
+          seen += 1
+
+      return {"data": rows,
+              "total": total,
+              "page": page,
+              "page_size": page_size,
+              "version": self.tag()}
+
+
+def best_encoding(accept_encoding):
+  """Picks the best compression for an Accept-Encoding header."""
+  accepted = [e.split(";")[0].strip() for e in (accept_encoding or "").split(",")]
+  if "br" in accepted and brotli is not None:
+    return "br"
+  if "gzip" in accepted:
+    return "gzip"
+  return None
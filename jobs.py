@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+"""Background measurement jobs for the web tool.
+
+A job measures a selection of fonts on a pool of worker processes (see
+util.measure_fonts), on a thread of its own so that the web server keeps
+answering requests meanwhile. Jobs run one after the other, in the order
+they were submitted.
+
+Every finished font becomes a "row" event of its job, and the job's
+final status an "end" event. Events are kept for as long as the job is,
+so clients can follow a job as a Server-Sent Events stream (see
+server_sent_events) from its start or from any event they already saw,
+e.g. after reconnecting.
+"""
+import collections
+import itertools
+import json
+import queue
+import threading
+import time
+
+from util import measure_fonts
+
+# Finished jobs kept around for their status and events:
+MAX_FINISHED_JOBS = 100
+# Seconds between comments sent to keep idle event streams open:
+KEEPALIVE_INTERVAL = 15
+
+
+# A font to measure: the row it belongs to, and how to measure it.
+JobItem = collections.namedtuple('JobItem', ['gfn', 'rowid', 'fontfile', 'subsets'])
+
+
+class Job(object):
+  """The state of a measurement job: queued, running, then either done,
+     cancelled or failed."""
+
+  def __init__(self, jobid, items):
+    self.id = jobid
+    self.items = items
+    self.state = "queued"
+    self.error = None
+    self.failed = 0
+    self.created = time.time()
+    self.started = None
+    self.finished = None
+    self.events = []
+    self.cancelled = False
+    self._changed = threading.Condition()
+
+  def _set_state(self, state):
+    with self._changed:
+      self.state = state
+      if state == "running":
+        self.started = time.time()
+      else:
+        self.finished = time.time()
+        # the last event of every job:
+        self.events.append(("end", self.status()))
+      self._changed.notify_all()
+
+  def add_event(self, kind, data):
+    with self._changed:
+      self.events.append((kind, data))
+      self._changed.notify_all()
+
+  def cancel(self):
+    """Stops the job after the fonts that are being measured already."""
+    self.cancelled = True
+
+  @property
+  def done(self):
+    return self.state in ("done", "cancelled", "failed")
+
+  def status(self):
+    """The job's status, as sent to clients."""
+    with self._changed:
+      return {"id": self.id,
+              "state": self.state,
+              "total": len(self.items),
+              "measured": len([kind for kind, _ in self.events if kind == "row"]),
+              "failed": self.failed,
+              "error": self.error,
+              "created": self.created,
+              "started": self.started,
+              "finished": self.finished}
+
+  def follow(self, since=0, timeout=None):
+    """Yields the (index, kind, data) events of the job from the one
+       numbered since (0 is the first), waiting for new ones until the
+       job is over. Yields None after timeout seconds without events."""
+    index = since
+    while True:
+      with self._changed:
+        if index >= len(self.events) and not self.done:
+          self._changed.wait(timeout)
+        events = self.events[index:]
+        over = self.done
+      if not events and not over:
+        yield None
+      for kind, data in events:
+        index += 1
+        yield index, kind, data
+      if over and index >= len(self.events):
+        return
+
+
+def server_sent_events(job, since=0):
+  """Yields a job's events in the text/event-stream format. The event
+     ids let clients resume with a Last-Event-ID header."""
+  for event in job.follow(since, KEEPALIVE_INTERVAL):
+    if event is None:
+      yield ": keepalive\n\n"
+      continue
+    index, kind, data = event
+    yield "id: {}\nevent: {}\ndata: {}\n\n".format(index, kind, json.dumps(data))
+
+
+class JobRunner(threading.Thread):
+  """Background thread running the submitted jobs.
+
+  on_result(item, darkness, width, angle, error) is called on this thread
+  for every measured font, and returns the data of its "row" event (it
+  is where the results get into the grid). processes, timeout and
+  memory_limit are passed on to util.measure_fonts, and cache is a
+  callable returning a new MeasurementCache (sqlite connections can't
+  be shared across threads).
+  """
+
+  def __init__(self, on_result, processes=1, timeout=None, memory_limit=None,
+               cache=None):
+    super(JobRunner, self).__init__()
+    self.daemon = True
+    self.on_result = on_result
+    self.processes = processes
+    self.timeout = timeout
+    self.memory_limit = memory_limit
+    self.cache = cache
+    self.jobs = collections.OrderedDict()
+    self._ids = itertools.count(1)
+    self._lock = threading.Lock()
+    self._queue = queue.Queue()
+
+  def submit(self, items):
+    """Queues a job measuring a list of JobItems, and returns it."""
+    with self._lock:
+      job = Job(str(next(self._ids)), items)
+      self.jobs[job.id] = job
+      finished = [jobid for jobid, j in self.jobs.items() if j.done]
+      for jobid in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+        del self.jobs[jobid]
+    self._queue.put(job)
+    return job
+
+  def get(self, jobid):
+    with self._lock:
+      return self.jobs.get(jobid)
+
+  def run(self):
+    while True:
+      job = self._queue.get()
+      if job.cancelled:
+        job._set_state("cancelled")
+        continue
+      job._set_state("running")
+      try:
+        self.measure(job)
+      except Exception as e:
+        job.error = "{}: {}".format(type(e).__name__, e)
+        print ("Job {} failed: {}".format(job.id, job.error))
+        job._set_state("failed")
+      else:
+        job._set_state("cancelled" if job.cancelled else "done")
+
+  def measure(self, job):
+    cache = self.cache() if self.cache is not None else None
+    try:
+      results = measure_fonts(((item.fontfile, item.subsets) for item in job.items),
+                              self.processes, cache, self.timeout, self.memory_limit)
+      try:
+        # results come back in the order of the items:
+        for (_, _, darkness, width, angle, error), item in zip(results, job.items):
+          if error is not None:
+            job.failed += 1
+          job.add_event("row", self.on_result(item, darkness, width, angle, error))
+          if job.cancelled:
+            break
+      finally:
+        # (when cancelled, stops the worker processes and commits the
+        # measurements taken so far to the cache)
+        results.close()
+    finally:
+      if cache is not None:
+        cache.close()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""On-disk cache of raw darkness/width/angle measurements.
+
+Entries are keyed by the contents of the font file together with
+everything else that affects the rendering (sample text, font size and
+the measurement code version), so renaming or moving a font keeps its
+entry valid while any change to its binary invalidates it.
+"""
+import os
+import sqlite3
+import time
+
+from util import render_key
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache",
+                                  "font-classification-tool",
+                                  "measurements.sqlite3")
+DEFAULT_MAX_ENTRIES = 100000
+
+
+class MeasurementCache(object):
+  """A size-bounded, least-recently-used store of (darkness, width, angle)
+     triples."""
+
+  def __init__(self, path=DEFAULT_CACHE_PATH, max_entries=DEFAULT_MAX_ENTRIES):
+    self.path = path
+    self.max_entries = max_entries
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    self._db = sqlite3.connect(path)
+    self._db.execute("CREATE TABLE IF NOT EXISTS measurements ("
+                     " key TEXT PRIMARY KEY,"
+                     " darkness REAL NOT NULL,"
+                     " width REAL NOT NULL,"
+                     " last_used REAL NOT NULL,"
+                     " angle REAL)")
+    columns = [row[1] for row in self._db.execute("PRAGMA table_info(measurements)")]
+    if "angle" not in columns:
+      # caches from before angles were measured: their entries
+      # stay around, but count as misses until measured again
+      self._db.execute("ALTER TABLE measurements ADD COLUMN angle REAL")
+    self._db.execute("CREATE INDEX IF NOT EXISTS measurements_last_used"
+                     " ON measurements (last_used)")
+
+  def key(self, fontfile, subsets, engine="raster", variations=None):
+    """Returns the cache key for measuring fontfile (or one instance of
+       it, for variable fonts) with the sample text selected by the given
+       subsets, and the given engine."""
+    return render_key(fontfile, subsets, engine, variations)
+
+  def get(self, key):
+    """Returns the cached (darkness, width, angle) for key, or None."""
+    row = self._db.execute("SELECT darkness, width, angle FROM measurements"
+                           " WHERE key = ?", (key,)).fetchone()
+    if row is None or row[2] is None:
+      return None
+    self._db.execute("UPDATE measurements SET last_used = ? WHERE key = ?",
+                     (time.time(), key))
+    return tuple(row)
+
+  def put(self, key, darkness, width, angle):
+    self._db.execute("INSERT OR REPLACE INTO measurements"
+                     " (key, darkness, width, angle, last_used) VALUES (?, ?, ?, ?, ?)",
+                     (key, darkness, width, angle, time.time()))
+
+  def commit(self):
+    """Evicts the least recently used entries beyond max_entries and
+       writes everything to disk."""
+    self._db.execute("DELETE FROM measurements WHERE key IN ("
+                     " SELECT key FROM measurements"
+                     " ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                     (self.max_entries,))
+    self._db.commit()
+
+  def clear(self):
+    self._db.execute("DELETE FROM measurements")
+    self._db.commit()
+
+  def __len__(self):
+    return self._db.execute("SELECT COUNT(*) FROM measurements").fetchone()[0]
+
+  def close(self):
+    self._db.close()
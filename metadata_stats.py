@@ -1,12 +1,94 @@
 #!/usr/bin/env python3
 import sys
+import json
 from util import read_csv
 
+try:
+  import numpy
+except ImportError:
+  sys.exit("Needs numpy.\n\npip3 install numpy")
+
 import argparse
 DESCRIPTION = "Compute some useful stats about the font metadata CSV contents."
 parser = argparse.ArgumentParser(description=DESCRIPTION)
-parser.add_argument("-m", "--metadata", default="input.csv", required=True,
-                    help="CSV metadata filename")
+parser.add_argument("-m", "--metadata", default="input.csv", required=True, nargs="+",
+                    help="CSV metadata filename(s)")
+parser.add_argument("-j", "--json", default=False, action='store_true',
+                    help="Print the stats as JSON instead of markdown")
+
+SCORES = [v+1 for v in range(10)]
+USAGES = ['?', 'body', 'header']
+
+
+def _column(metadata, field):
+  """Zero-copy view of one of the integer columns of a MetadataTable."""
+  return numpy.frombuffer(metadata.columns[field], dtype=numpy.int16)
+
+
+def compute_stats(metadata):
+  """Computes every histogram and cross-tab of a MetadataTable, with a
+     single vectorized pass over each column."""
+  stats = {}
+  valid = {}
+  for name, field in [('weight', 'weight_int'),
+                      ('width', 'width_int'),
+                      ('angle', 'angle_int')]:
+    values = _column(metadata, field)
+    valid[name] = (values >= 1) & (values <= 10)
+    counts = numpy.bincount(values[valid[name]], minlength=11)
+    stats[name] = {v: int(counts[v]) for v in SCORES}
+    stats[name + ' (unset: -1)'] = int((values == -1).sum())
+    stats[name + ' (invalid)'] = int((~valid[name] & (values != -1)).sum())
+
+  # usage and subsets are interned, so count the codes and look them up:
+  usage_counts = numpy.bincount(numpy.frombuffer(metadata.columns['usage'], dtype=numpy.uint16),
+                                minlength=len(metadata.strings))
+  by_usage = {metadata.strings[code]: int(count)
+              for code, count in enumerate(usage_counts) if count}
+  stats['usage'] = {v: by_usage.get(v, 0) for v in USAGES}
+  stats['usage (other)'] = sum(count for usage, count in by_usage.items()
+                               if usage not in USAGES)
+
+  # weight x width cross-tab, over the fonts that have both values:
+  weight = _column(metadata, 'weight_int')
+  width = _column(metadata, 'width_int')
+  both = valid['weight'] & valid['width']
+  cells = numpy.bincount((weight[both] - 1) * 10 + (width[both] - 1), minlength=100)
+  cells = cells.reshape(10, 10)
+  stats['weight x width'] = {w: {wi: int(cells[w-1][wi-1]) for wi in SCORES}
+                             for w in SCORES}
+
+  # fonts and weight histogram per subset:
+  subsets_codes = numpy.frombuffer(metadata.columns['subsets'], dtype=numpy.uint16)
+  weight_bins = numpy.where(valid['weight'], weight, 0)
+  per_code = numpy.bincount(subsets_codes.astype(numpy.int64) * 11 + weight_bins,
+                            minlength=len(metadata.strings) * 11)
+  per_code = per_code.reshape(len(metadata.strings), 11)
+  by_subset = {}
+  for code, counts in enumerate(per_code):
+    if not counts.any() or not metadata.strings[code]:
+      continue
+    for subset in metadata.strings[code].split('+'):
+      if subset not in by_subset:
+        by_subset[subset] = numpy.zeros(11, dtype=numpy.int64)
+      by_subset[subset] += counts
+  stats['subsets'] = {subset: {'fonts': int(counts.sum()),
+                               'weight': {v: int(counts[v]) for v in SCORES}}
+                      for subset, counts in sorted(by_subset.items())}
+  return stats
+
+
+def print_stats(stats):
+  for field in stats:
+    if isinstance(stats[field], dict):
+      print("\n## {}".format(field))
+      for v in stats[field]:
+        value = stats[field][v]
+        if isinstance(value, dict):
+          value = ", ".join("{}={}".format(k, value[k]) for k in value)
+        print("* {}: {}".format(v, value))
+    else:
+      print("\n## {}: {}".format(field, stats[field]))
 
 
 def main():
@@ -16,18 +98,17 @@ def main():
     parser.print_help()
     sys.exit(-1)
 
-  metadata = read_csv(args.metadata)
-
-  stats = {}
-  stats['weight'] = {v+1 : len([entry for entry in metadata if metadata[entry]['weight_int'] == v+1]) for v in range(10)}
-  stats['width'] = {v+1 : len([entry for entry in metadata if metadata[entry]['width_int'] == v+1]) for v in range(10)}
-  stats['angle'] = {v+1 : len([entry for entry in metadata if metadata[entry]['angle_int'] == v+1]) for v in range(10)}
-  stats['usage'] = {v : len([entry for entry in metadata if metadata[entry]['usage'] == v]) for v in ['?', 'body', 'header']}
+  all_stats = {}
+  for filename in args.metadata:
+    all_stats[filename] = compute_stats(read_csv(filename))
 
-  for field in stats:
-    print("\n## {}".format(field))
-    for v in stats[field]:
-      print("* {}: {}".format(v, stats[field][v]))
+  if args.json:
+    print(json.dumps(all_stats, indent=2))
+  else:
+    for filename, stats in all_stats.items():
+      if len(args.metadata) > 1:
+        print("\n# {}".format(filename))
+      print_stats(stats)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""Darkness and width measured on the glyph outlines, without rendering.
+
+The sample text is laid out with the advance widths from hmtx (no
+kerning, like the cairo renderer). Then:
+
+  darkness = ink area of the glyphs / area of the ink bounding box
+  width = width of the ink bounding box / height of the "x" ink
+
+which is what the raster engine computes from a 30px rendering, minus
+its antialiasing and pixel rounding. Overlapping contours within a
+glyph get counted twice (a rasterizer counts them once), but fonts
+are rarely shipped with overlaps.
+
+The italic angle comes from the post table, and for italics that leave
+it at 0, from the slant of the straight, steep segments of the outlines
+(the stems).
+"""
+import math
+import sys
+
+try:
+  from fontTools.pens.areaPen import AreaPen
+  from fontTools.pens.basePen import BasePen
+  from fontTools.pens.boundsPen import BoundsPen
+  from fontTools.ttLib import TTFont
+except ImportError:
+  sys.exit("Needs fontTools.\n\npip3 install fonttools")
+
+from util import (instance_slant,
+                  parse_variations)
+
+
+def _glyph_name(cmap, char):
+  return cmap.get(ord(char), ".notdef")
+
+
+def _ink(glyphset, name):
+  """Returns (area, bounds) of a glyph, bounds being None for blank glyphs."""
+  glyph = glyphset[name]
+  area_pen = AreaPen(glyphset)
+  glyph.draw(area_pen)
+  bounds_pen = BoundsPen(glyphset)
+  glyph.draw(bounds_pen)
+  return abs(area_pen.value), bounds_pen.bounds
+
+
+def text_ink(glyphset, cmap, text):
+  """Lays out text along the advance widths and returns its total ink
+     area and ink bounding box (xMin, yMin, xMax, yMax)."""
+  area = 0
+  bounds = None
+  x = 0
+  for char in text:
+    name = _glyph_name(cmap, char)
+    glyph_area, glyph_bounds = _ink(glyphset, name)
+    area += glyph_area
+    if glyph_bounds is not None:
+      xMin, yMin, xMax, yMax = glyph_bounds
+      glyph_bounds = (x + xMin, yMin, x + xMax, yMax)
+      if bounds is None:
+        bounds = glyph_bounds
+      else:
+        bounds = (min(bounds[0], glyph_bounds[0]), min(bounds[1], glyph_bounds[1]),
+                  max(bounds[2], glyph_bounds[2]), max(bounds[3], glyph_bounds[3]))
+    x += glyphset[name].width
+  return area, bounds
+
+
+def measure_glyphset(glyphset, cmap, sample_text, sample_xheight):
+  """Returns the (darkness, width) of the sample text set in glyphset."""
+  area, bounds = text_ink(glyphset, cmap, sample_text)
+  if bounds is None:
+    raise ValueError("the sample text has no ink")
+  xMin, yMin, xMax, yMax = bounds
+  darkness = area / float((xMax - xMin) * (yMax - yMin))
+
+  _, xbounds = text_ink(glyphset, cmap, sample_xheight)
+  if xbounds is None:
+    raise ValueError("the x-height sample has no ink")
+  x_height = xbounds[3] - xbounds[1]
+  return darkness, (xMax - xMin) / float(x_height)
+
+
+class _StemPen(BasePen):
+  """Collects the (angle, length) of the straight segments of glyphs
+     that are closer to vertical than max_angle degrees."""
+
+  def __init__(self, glyphset, max_angle=35):
+    BasePen.__init__(self, glyphset)
+    self.max_angle = max_angle
+    self.stems = []
+
+  def _moveTo(self, pt):
+    pass
+
+  def _lineTo(self, pt):
+    (x0, y0), (x1, y1) = self._getCurrentPoint(), pt
+    dx, dy = x1 - x0, y1 - y0
+    if dy == 0:
+      return
+    if dy < 0:
+      dx, dy = -dx, -dy
+    angle = math.degrees(math.atan2(dx, dy))
+    if abs(angle) <= self.max_angle:
+      self.stems.append((angle, math.hypot(dx, dy)))
+
+  def _curveToOne(self, pt1, pt2, pt3):
+    pass
+
+  def _qCurveToOne(self, pt1, pt2):
+    pass
+
+
+def stem_angle(glyphset, cmap, text):
+  """Estimates the slant of text in degrees (positive leaning to the
+     right) as the length weighted median angle of its stems, ignoring
+     the segments shorter than a fifth of the longest one."""
+  pen = _StemPen(glyphset)
+  for char in set(text):
+    glyphset[_glyph_name(cmap, char)].draw(pen)
+  if not pen.stems:
+    return 0.0
+  longest = max(length for _, length in pen.stems)
+  stems = sorted((angle, length) for angle, length in pen.stems if length >= longest / 5)
+  half = sum(length for _, length in stems) / 2.0
+  for angle, length in stems:
+    half -= length
+    if half <= 0:
+      return round(angle, 1)
+
+
+def font_slant(ttfont):
+  """The (italic angle, italic) of a font: its post.italicAngle, turned
+     into degrees leaning to the right, and whether its OS/2 or head
+     table says it is an italic."""
+  italic = ('OS/2' in ttfont and ttfont['OS/2'].fsSelection & 1 or
+            ttfont['head'].macStyle & 2)
+  return 0.0 - ttfont['post'].italicAngle, bool(italic)
+
+
+def outline_angle(glyphset, cmap, sample_text, angle, italic):
+  """The italic angle of a glyphset, given the (italic angle, italic)
+     of its font: italics that leave the angle at 0 get it estimated
+     from their stems."""
+  if angle == 0 and italic:
+    return stem_angle(glyphset, cmap, sample_text)
+  return angle
+
+
+def measure_outlines(fontfile, sample_text, sample_xheight, variations=None):
+  """Returns the (darkness, width, angle) of a font file, from its
+     outlines. variations selects an instance of a variable font, given
+     as "wght=700,wdth=100" variation coordinates."""
+  ttfont = TTFont(fontfile, lazy=True)
+  try:
+    location = parse_variations(variations) if variations else None
+    glyphset = ttfont.getGlyphSet(location=location)
+    cmap = ttfont.getBestCmap()
+    darkness, width = measure_glyphset(glyphset, cmap, sample_text, sample_xheight)
+    angle, italic = font_slant(ttfont)
+    if location:
+      angle, italic = instance_slant(angle, italic, location)
+    return darkness, width, outline_angle(glyphset, cmap, sample_text, angle, italic)
+  finally:
+    ttfont.close()
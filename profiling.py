@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""Per-font, per-stage timings of classification runs.
+
+Code paths worth timing are wrapped in `with stage(name, font):` blocks,
+which do nothing unless a Profiler was enabled (see --profile). Worker
+processes record into their copy of the profiler and hand the events
+back along with their results, see util.measure_fonts.
+
+A profile can be printed as a summary table (the slowest stages and
+fonts) and saved as Chrome trace-event JSON, which can be loaded into
+chrome://tracing or https://ui.perfetto.dev
+"""
+import collections
+import contextlib
+import json
+import os
+import resource
+import threading
+import time
+
+# An event is a (stage, font, start, duration, pid, tid, args) tuple,
+# with start and duration in seconds on the time.perf_counter() clock,
+# which on Linux is shared by all processes.
+Event = collections.namedtuple('Event', ['stage', 'font', 'start', 'duration',
+                                         'pid', 'tid', 'args'])
+
+
+def peak_rss_kb(who=resource.RUSAGE_SELF):
+  """Peak resident set size, in kilobytes."""
+  return resource.getrusage(who).ru_maxrss
+
+
+class Profiler(object):
+
+  def __init__(self):
+    self.events = []
+    self.start = time.perf_counter()
+    self._lock = threading.Lock()
+
+  def add(self, stage, font, start, duration, **args):
+    event = Event(stage, font, start, duration,
+                  os.getpid(), threading.get_ident(), args)
+    with self._lock:
+      self.events.append(event)
+
+  @contextlib.contextmanager
+  def stage(self, name, font=None, **args):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.add(name, font, start, time.perf_counter() - start, **args)
+
+  def mark(self):
+    """Returns a position for take_events()."""
+    return len(self.events)
+
+  def take_events(self, mark):
+    """Removes and returns the events recorded since mark."""
+    with self._lock:
+      events = self.events[mark:]
+      del self.events[mark:]
+    return events
+
+  def extend(self, events):
+    with self._lock:
+      self.events.extend(Event(*event) for event in events)
+
+  def summary(self, slowest=10):
+    """Returns a plain text table of the time spent per stage, and of
+       the fonts that took the longest."""
+    stages = collections.OrderedDict()
+    fonts = collections.defaultdict(lambda: collections.defaultdict(float))
+    rss = {}
+    for event in self.events:
+      durations = stages.setdefault(event.stage, [])
+      durations.append(event.duration)
+      if event.font is not None:
+        fonts[event.font][event.stage] += event.duration
+        if "rss_kb" in event.args:
+          rss[event.font] = event.args["rss_kb"]
+
+    lines = ["{:<12} {:>8} {:>10} {:>10} {:>10}".format("stage", "count", "total s",
+                                                        "mean ms", "max ms")]
+    for name, durations in stages.items():
+      lines.append("{:<12} {:>8} {:>10.3f} {:>10.2f} {:>10.2f}".format(
+        name, len(durations), sum(durations),
+        1000 * sum(durations) / len(durations), 1000 * max(durations)))
+
+    # "measure" wraps the other per-font stages, so don't count it twice:
+    def total(font):
+      return sum(d for name, d in fonts[font].items() if name != "measure")
+
+    lines += ["", "{:<10} {:>10} {:<12} {}".format("font ms", "rss kb", "worst stage", "font")]
+    for font in sorted(fonts, key=total, reverse=True)[:slowest]:
+      worst = max((d, name) for name, d in fonts[font].items() if name != "measure")[1]
+      lines.append("{:<10.2f} {:>10} {:<12} {}".format(1000 * total(font),
+                                                       rss.get(font, ""), worst, font))
+
+    # (supervised workers are started by a fork server, so they aren't
+    # children of this process: use what they reported instead)
+    largest_worker = max([peak_rss_kb(resource.RUSAGE_CHILDREN)] +
+                         [event.args["rss_kb"] for event in self.events
+                          if "rss_kb" in event.args and event.pid != os.getpid()])
+    lines += ["", "peak RSS: {} kB (main process), {} kB (largest worker)".format(
+      peak_rss_kb(), largest_worker)]
+    return "\n".join(lines)
+
+  def chrome_trace(self):
+    """Returns the events in the Chrome trace-event format."""
+    trace = []
+    for event in self.events:
+      args = dict(event.args)
+      if event.font is not None:
+        args["font"] = event.font
+      trace.append({"name": event.stage,
+                    "cat": "font" if event.font is not None else "run",
+                    "ph": "X",
+                    "ts": 1e6 * (event.start - self.start),
+                    "dur": 1e6 * event.duration,
+                    "pid": event.pid,
+                    "tid": event.tid,
+                    "args": args})
+      if "rss_kb" in event.args:
+        trace.append({"name": "peak RSS (kB)",
+                      "ph": "C",
+                      "ts": 1e6 * (event.start + event.duration - self.start),
+                      "pid": event.pid,
+                      "args": {"rss": event.args["rss_kb"]}})
+    return {"traceEvents": trace, "displayTimeUnit": "ms"}
+
+  def save_chrome_trace(self, filename):
+    with open(filename, "w") as f:
+      json.dump(self.chrome_trace(), f)
+
+  def report(self, filename):
+    """Prints the summary table and saves the Chrome trace to filename."""
+    print ("\n" + self.summary() + "\n")
+    self.save_chrome_trace(filename)
+    print ("Chrome trace written to {}".format(filename))
+
+
+_active = None
+
+def enable():
+  """Starts recording stages into a new Profiler, and returns it."""
+  global _active
+  _active = Profiler()
+  return _active
+
+
+def active():
+  """Returns the Profiler being recorded into, or None."""
+  return _active
+
+
+@contextlib.contextmanager
+def stage(name, font=None, **args):
+  """Times the enclosed block as a stage of processing font, if
+     profiling is enabled."""
+  if _active is None:
+    yield
+  else:
+    with _active.stage(name, font, **args):
+      yield
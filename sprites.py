@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""Sprite sheets of sample line thumbnails.
+
+Instead of one PNG (and one HTTP request) per font, the web tool can pack
+every sample line into a few large sheets. A JSON map records where each
+font's line ended up, so the grid can show it as a CSS background region.
+
+Sheets are named after a hash of the render keys of every font they
+contain, so an unchanged set of fonts reuses the sheets built by a
+previous run.
+"""
+import hashlib
+import json
+import os
+
+from util import (alpha_png,
+                  render_key,
+                  render_sample)
+
+SHEET_WIDTH = 2048
+SHEET_HEIGHT = 4096
+
+
+def pack_shelves(sizes, sheet_width=SHEET_WIDTH, sheet_height=SHEET_HEIGHT):
+  """Places rectangles of the given (width, height) sizes, in order, on
+     horizontal shelves spanning a series of sheets.
+     Returns a list of (sheet, x, y) positions."""
+  positions = []
+  sheet = x = y = shelf_height = 0
+  for width, height in sizes:
+    if x > 0 and x + width > sheet_width:
+      # next shelf
+      x, y = 0, y + shelf_height
+      shelf_height = 0
+    if y > 0 and y + height > sheet_height:
+      # next sheet
+      sheet, x, y = sheet + 1, 0, 0
+    positions.append((sheet, x, y))
+    x += width
+    shelf_height = max(shelf_height, height)
+  return positions
+
+
+class SpriteAtlas(object):
+
+  def __init__(self, cachedir):
+    self.cachedir = cachedir
+    if not os.path.isdir(cachedir):
+      os.makedirs(cachedir)
+
+  def build(self, fonts, on_render=None):
+    """Packs the sample lines of fonts, a list of (gfn, fontfile, subsets)
+       tuples, into sprite sheets.
+
+       Returns a dict gfn:{"sheet", "x", "y", "w", "h"} where "sheet" is
+       the filename of the sheet within cachedir. Fonts that fail to render
+       are left out. on_render(gfn, render) is called for every font that
+       had to be rendered, so that callers can reuse the raster.
+    """
+    keys = [render_key(fontfile, subsets) for _, fontfile, subsets in fonts]
+    layout = "{}x{}".format(SHEET_WIDTH, SHEET_HEIGHT)
+    atlas_key = hashlib.sha1("\n".join([layout] + keys).encode("utf-8")).hexdigest()
+    map_path = os.path.join(self.cachedir, atlas_key + ".json")
+    if os.path.exists(map_path):
+      with open(map_path) as f:
+        return json.load(f)
+
+    renders = []
+    for gfn, fontfile, subsets in fonts:
+      try:
+        render = render_sample(fontfile, subsets)
+      except Exception as e:
+        print ("Failed to render {}: {}".format(fontfile, e))
+        continue
+      if on_render is not None:
+        try:
+          on_render(gfn, render)
+        except Exception as e:
+          # the sample line is fine, whatever the callback thought of it:
+          print ("Failed to process {}: {}".format(fontfile, e))
+      surface = render.surface
+      renders.append((gfn, surface.get_width(), surface.get_height(),
+                      surface.get_stride(), bytes(surface.get_data())))
+
+    positions = pack_shelves([(width, height) for _, width, height, _, _ in renders])
+    sheet_count = positions[-1][0] + 1 if positions else 0
+    sheets = [bytearray(SHEET_WIDTH * SHEET_HEIGHT) for _ in range(sheet_count)]
+    sheet_heights = [0] * sheet_count
+
+    offsets = {}
+    for (gfn, width, height, stride, data), (sheet, x, y) in zip(renders, positions):
+      # sample lines wider than a whole sheet get cropped:
+      width = min(width, SHEET_WIDTH)
+      height = min(height, SHEET_HEIGHT)
+      pixels = sheets[sheet]
+      for row in range(height):
+        start = (y + row) * SHEET_WIDTH + x
+        pixels[start:start + width] = data[row*stride:row*stride + width]
+      sheet_heights[sheet] = max(sheet_heights[sheet], y + height)
+      offsets[gfn] = {"sheet": "{}-{}.png".format(atlas_key, sheet),
+                      "x": x, "y": y, "w": width, "h": height}
+
+    for sheet, pixels in enumerate(sheets):
+      path = os.path.join(self.cachedir, "{}-{}.png".format(atlas_key, sheet))
+      with open(path, "wb") as f:
+        f.write(alpha_png(SHEET_WIDTH, sheet_heights[sheet], SHEET_WIDTH, pixels))
+
+    # the map goes last, as it marks the atlas as complete:
+    with open(map_path + ".tmp", "w") as f:
+      json.dump(offsets, f)
+    os.replace(map_path + ".tmp", map_path)
+    return offsets
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""Supervised worker processes, and the quarantine of fonts that kill them.
+
+Some fonts make FreeType or cairo hang, exhaust memory or crash the
+interpreter outright (see util.BLOCKLIST). SupervisedPool runs every task
+in a worker process with a time limit and an address space limit: a
+worker that goes over its time is killed, one that dies is noticed, and
+either way it is replaced by a fresh one while the other workers keep
+going. The failed task raises a WorkerFailure.
+
+Fonts that failed like that are recorded in a Quarantine file, together
+with the reason, so that later runs skip them instead of failing on them
+again. Entries are keyed by the font's contents, so a fixed font binary
+gets measured again.
+"""
+import collections
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import resource
+import signal
+import time
+
+import profiling
+from util import font_digest
+
+DEFAULT_QUARANTINE_PATH = os.path.join(os.path.expanduser("~"), ".cache",
+                                       "font-classification-tool",
+                                       "quarantine.json")
+DEFAULT_TIMEOUT = 120
+DEFAULT_MEMORY_LIMIT = 2048 # in MB
+
+
+class WorkerFailure(Exception):
+  """A task took its worker down with it."""
+
+class WorkerTimeout(WorkerFailure):
+  pass
+
+class WorkerCrash(WorkerFailure):
+  pass
+
+
+# Error messages (as formatted by util._measure) that mean a font should
+# be quarantined, as opposed to it merely failing to render:
+FATAL_ERRORS = ["WorkerTimeout", "WorkerCrash", "MemoryError", "RecursionError"]
+
+def is_fatal(error):
+  return error.split(":")[0] in FATAL_ERRORS
+
+
+# Workers are started by a fork server rather than forked from the parent,
+# which may be running other threads (eg the web tool's): a child forked
+# while one of them held a lock (like the stdout one) would hang on it.
+_context = multiprocessing.get_context("forkserver")
+
+
+def _worker_main(conn, memory_limit, profile):
+  if profile:
+    # (the parent's profiler doesn't make it into fresh processes)
+    profiling.enable()
+  if memory_limit:
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    resource.setrlimit(resource.RLIMIT_AS, (memory_limit * 1024 * 1024, hard))
+  while True:
+    try:
+      task = conn.recv()
+    except EOFError:
+      return
+    if task is None:
+      return
+    func, args = task
+    try:
+      conn.send((True, func(*args)))
+    except Exception as e:
+      conn.send((False, e))
+
+
+class _Task(object):
+
+  def __init__(self, pool, func, args):
+    self.pool = pool
+    self.func = func
+    self.args = args
+    self.done = False
+    self.value = None
+    self.exception = None
+
+  def ready(self):
+    self.pool._poll(block=False)
+    return self.done
+
+  def get(self):
+    while not self.done:
+      self.pool._poll(block=True)
+    if self.exception is not None:
+      raise self.exception
+    return self.value
+
+
+class _Worker(object):
+
+  def __init__(self, memory_limit):
+    self.conn, child_conn = _context.Pipe()
+    self.process = _context.Process(target=_worker_main,
+                                    args=(child_conn, memory_limit,
+                                          profiling.active() is not None))
+    self.process.daemon = True
+    self.process.start()
+    child_conn.close()
+    self.task = None
+    self.deadline = None
+
+
+class SupervisedPool(object):
+  """A process pool like multiprocessing.Pool (apply_async, terminate,
+     join), in which a task that hangs or crashes only costs a worker."""
+
+  def __init__(self, processes, timeout=DEFAULT_TIMEOUT, memory_limit=DEFAULT_MEMORY_LIMIT):
+    """timeout is in seconds, memory_limit in megabytes; None or 0
+       disables either limit."""
+    self.timeout = timeout
+    self.memory_limit = memory_limit
+    self._queue = collections.deque()
+    self._workers = [_Worker(memory_limit) for _ in range(max(1, processes))]
+
+  def apply_async(self, func, args=()):
+    task = _Task(self, func, args)
+    self._queue.append(task)
+    self._dispatch()
+    return task
+
+  def _dispatch(self):
+    for worker in self._workers:
+      if worker.task is None and self._queue:
+        worker.task = self._queue.popleft()
+        worker.conn.send((worker.task.func, worker.task.args))
+        if self.timeout:
+          worker.deadline = time.monotonic() + self.timeout
+
+  def _replace(self, worker, exception):
+    """Fails the worker's task and puts a new worker in its place."""
+    worker.process.join()
+    worker.conn.close()
+    worker.task.exception = exception
+    worker.task.done = True
+    self._workers[self._workers.index(worker)] = _Worker(self.memory_limit)
+
+  def _poll(self, block):
+    """Collects finished tasks, and kills and replaces the workers whose
+       task took too long or that died. With block, waits until at least
+       something happened."""
+    self._dispatch()
+    busy = [worker for worker in self._workers if worker.task is not None]
+    if not busy:
+      return
+
+    wait = 0
+    if block:
+      deadlines = [worker.deadline for worker in busy if worker.deadline is not None]
+      wait = max(0, min(deadlines) - time.monotonic()) if deadlines else None
+    multiprocessing.connection.wait([worker.conn for worker in busy] +
+                                    [worker.process.sentinel for worker in busy], wait)
+
+    for worker in busy:
+      if worker.conn.poll():
+        try:
+          ok, value = worker.conn.recv()
+        except (EOFError, OSError):
+          pass # it died while sending, handled below
+        else:
+          task, worker.task, worker.deadline = worker.task, None, None
+          task.value, task.exception = (value, None) if ok else (None, value)
+          task.done = True
+          continue
+
+      if not worker.process.is_alive():
+        code = worker.process.exitcode
+        if code is not None and code < 0:
+          reason = "worker died with {}".format(signal.Signals(-code).name)
+        else:
+          reason = "worker exited with code {}".format(code)
+        self._replace(worker, WorkerCrash(reason))
+      elif worker.deadline is not None and time.monotonic() >= worker.deadline:
+        worker.process.kill()
+        self._replace(worker, WorkerTimeout("no result after {}s".format(self.timeout)))
+    self._dispatch()
+
+  def terminate(self):
+    for worker in self._workers:
+      worker.process.kill()
+
+  def join(self):
+    for worker in self._workers:
+      worker.process.join()
+      worker.conn.close()
+
+
+class Quarantine(object):
+  """Persisted record of the fonts that hung or crashed a worker."""
+
+  def __init__(self, path=DEFAULT_QUARANTINE_PATH):
+    self.path = path
+    self.entries = {}
+    self.changed = False
+    if os.path.exists(path):
+      with open(path) as f:
+        self.entries = json.load(f)
+
+  def reason(self, fontfile):
+    """Why fontfile was quarantined, or None if it wasn't."""
+    entry = self.entries.get(font_digest(fontfile))
+    return entry["reason"] if entry is not None else None
+
+  def __contains__(self, fontfile):
+    return self.reason(fontfile) is not None
+
+  def __len__(self):
+    return len(self.entries)
+
+  def add(self, fontfile, reason):
+    self.entries[font_digest(fontfile)] = {"font": fontfile,
+                                           "reason": reason,
+                                           "date": time.strftime("%Y-%m-%d %H:%M:%S")}
+    self.changed = True
+
+  def remove(self, fontfile):
+    if self.entries.pop(font_digest(fontfile), None) is not None:
+      self.changed = True
+
+  def save(self):
+    dirname = os.path.dirname(self.path)
+    if dirname and not os.path.isdir(dirname):
+      os.makedirs(dirname)
+    tmp = self.path + ".tmp"
+    with open(tmp, "w") as f:
+      json.dump(self.entries, f, indent=2, sort_keys=True)
+    os.replace(tmp, self.path)
+    self.changed = False
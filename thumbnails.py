@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""Disk cache of the sample line thumbnails shown by the web tool.
+
+Thumbnails are rendered the first time they are requested and stored
+under a name derived from the font's contents and the sample text
+(see util.render_key), so they survive server restarts and are only
+rendered again when the font binary changes.
+"""
+import os
+import tempfile
+
+import profiling
+from util import (coverage_png,
+                  render_key,
+                  render_sample)
+
+DEFAULT_THUMBNAIL_DIR = os.path.join(os.path.expanduser("~"), ".cache",
+                                     "font-classification-tool",
+                                     "thumbnails")
+
+
+class ThumbnailCache(object):
+
+  def __init__(self, cachedir=DEFAULT_THUMBNAIL_DIR):
+    self.cachedir = cachedir
+    if not os.path.isdir(cachedir):
+      os.makedirs(cachedir)
+
+  def get(self, fontfile, subsets):
+    """Returns (png_path, render) for a font. render is the SampleRender
+       if the thumbnail had to be rendered now, or None if it was cached."""
+    path = os.path.join(self.cachedir, render_key(fontfile, subsets) + ".png")
+    if os.path.exists(path):
+      return path, None
+
+    render = render_sample(fontfile, subsets)
+    # write to a temporary file of its own first, so that concurrent
+    # requests never get to see a partially written PNG:
+    with profiling.stage("png", fontfile):
+      png = coverage_png(render.surface)
+    fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.cachedir)
+    try:
+      with os.fdopen(fd, "wb") as f:
+        f.write(png)
+      os.replace(tmp, path)
+    except BaseException:
+      os.unlink(tmp)
+      raise
+    return path, render
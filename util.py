@@ -1,7 +1,23 @@
 #!/usr/bin/env python3
+from array import array
+import collections
+import collections.abc
 import csv
+import hashlib
 from math import floor
+import os
+import struct
 import sys
+import threading
+import time
+import zlib
+
+import profiling
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 
 def find_extremes(d):
@@ -12,47 +28,246 @@ def find_extremes(d):
   return min(values), max(values)
 
 
-def group_by_attributes(fonts):
+def _measure(font, engine="raster"):
+  """Pool worker: measures a single (filename, subsets, instances) font,
+     see measure_fonts.
+
+     Returns (filename, rows, events), where rows is a list of
+     (instance, darkness, width, angle, error) tuples. Exceptions are returned
+     instead of raised so that one bad font does not take the whole pool
+     down with it. When profiling, the events recorded while measuring
+     are returned as well, since they would otherwise stay behind in the
+     worker process.
+  """
+  name, subsets, instances = font
+  profiler = profiling.active()
+  if profiler is not None:
+    mark = profiler.mark()
+    start = time.perf_counter()
+  if instances is not None:
+    from variable_fonts import measure_instances
+    try:
+      rows = measure_instances(name, subsets, instances, engine)
+    except Exception as e:
+      error = "{}: {}".format(type(e).__name__, e)
+      rows = [(instance, None, None, None, error) for instance in instances]
+  else:
+    try:
+      rows = [(None,) + tuple(measure_font(name, subsets, engine=engine)) + (None,)]
+    except Exception as e:
+      rows = [(None, None, None, None, "{}: {}".format(type(e).__name__, e))]
+
+  events = None
+  if profiler is not None:
+    profiler.add("measure", name, start, time.perf_counter() - start,
+                 rss_kb=profiling.peak_rss_kb())
+    events = profiler.take_events(mark)
+  return name, rows, events
+
+
+def measure_fonts(fonts, jobs=1, cache=None, timeout=None, memory_limit=None, engine="raster"):
+  """ Computes the raw darkness, width and angle of a set of fonts, optionally
+      spreading the work across a pool of `jobs` processes.
+
+      Input: an iterable of (filename, subsets) pairs, which is consumed
+             lazily (so fonts can still be being discovered while the
+             first ones render), and an optional MeasurementCache.
+             Variable fonts can be given as (filename, subsets, instances)
+             instead, to measure a list of variable_fonts.Instance from a
+             single load of the font.
+             With a timeout (in seconds) or a memory_limit (in MB), every
+             font is measured by a supervised worker process instead,
+             see supervised_pool.SupervisedPool.
+             engine is one of ENGINES.
+      Output: a generator of (filename, instance, darkness, width, angle,
+              error) tuples in the same order as the input, one per
+              instance of variable fonts, and with instance None for other
+              fonts. darkness, width and angle are None (and error is a
+              message) for fonts that failed to render.
+  """
+  pool = None
+  if timeout or memory_limit:
+    from supervised_pool import SupervisedPool
+    pool = SupervisedPool(jobs, timeout, memory_limit)
+  elif jobs > 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+  # fonts are submitted to the pool at most this far ahead of the
+  # oldest result not handed back yet, which bounds the memory in use:
+  window = jobs * 4
+  # (font name, instances, cache keys, cached values, result or AsyncResult
+  # or None if everything was cached), in input order:
+  in_flight = collections.deque()
+  total = hits = 0
+
+  def done(pending):
+    return not hasattr(pending, "ready") or pending.ready()
+
+  def finish(name, instances, keys, cached, pending):
+    measured = {}
+    if pending is not None:
+      try:
+        _, rows, events = pending.get() if hasattr(pending, "get") else pending
+      except Exception as e:
+        # the worker hung or crashed:
+        error = "{}: {}".format(type(e).__name__, e)
+        rows, events = [(i, None, None, None, error) for i in instances if i not in cached], None
+      if events:
+        profiling.active().extend(events)
+      for instance, darkness, width, angle, error in rows:
+        measured[instance] = (darkness, width, angle, error)
+        if cache is not None and error is None:
+          cache.put(keys[instance], darkness, width, angle)
+    return [(name, instance) + (cached[instance] + (None,) if instance in cached
+                                else measured[instance])
+            for instance in instances]
+
+  try:
+    for font in fonts:
+      name, subsets = font[:2]
+      variable = len(font) > 2 and font[2] is not None
+      instances = font[2] if variable else [None]
+      total += len(instances)
+      keys = {}
+      cached = {}
+      if cache is not None:
+        with profiling.stage("cache", name):
+          for instance in instances:
+            keys[instance] = cache.key(name, subsets, engine,
+                                       format_variations(instance.coordinates) if variable else None)
+            value = cache.get(keys[instance])
+            if value is not None:
+              cached[instance] = value
+      hits += len(cached)
+
+      missing = [instance for instance in instances if instance not in cached]
+      work = (name, subsets, missing if variable else None)
+      if not missing:
+        pending = None
+      elif pool is None:
+        pending = _measure(work, engine)
+      else:
+        pending = pool.apply_async(_measure, (work, engine))
+      in_flight.append((name, instances, keys, cached, pending))
+
+      while in_flight and (len(in_flight) > window or done(in_flight[0][4])):
+        for row in finish(*in_flight.popleft()):
+          yield row
+    while in_flight:
+      for row in finish(*in_flight.popleft()):
+        yield row
+  finally:
+    if pool is not None:
+      # the consumer may have stopped early, with work still queued:
+      pool.terminate()
+      pool.join()
+    if cache is not None:
+      # (keeping what was measured before stopping, if so)
+      print ("{} of {} fonts found in the measurement cache.".format(hits, total))
+      cache.commit()
+
+
+def normalize(values):
+  """ Maps a dict of raw values into integer scores from 1 to 10
+      using the global min/max of all the values given.
+  """
+  min_value, max_value = find_extremes(values)
+  value_range = max_value - min_value
+
+  if value_range == 0: # unlikely
+    return {name: 5 for name in values}
+
+  return {name: min(10, int(1 + floor(10 * ((value - min_value) / value_range))))
+          for name, value in values.items()}
+
+
+def group_by_attributes(fonts, jobs=1, cache=None, engine="raster"):
   """ Classify a set of fonts by their ammount of black ink (percentage of dark
       pixels in a reference paragraph of text) and attribute a normalized score
       from 1 to 10 based on their computed darkness, effectively grouping the
       fonts by their weight.
 
-      Input: a list of font filenames
-      Output: a dict filename:value
-              where value is a weight score from 1 (lightest) to 10 (darkest)
+      Input: a list of (filename, subsets) pairs
+      Output: three dicts filename:value, for weight, width and angle,
+              where value is a score from 1 (lightest) to 10 (darkest)
+              Fonts that failed to render are reported and left out.
   """
   darkness = {}
   width = {}
-  for name, subsets in fonts:
-    darkness[name], width[name] = compute_darkness_and_width(name, subsets)
+  angle = {}
+  for name, _, dark, wide, slant, error in measure_fonts(fonts, jobs, cache, engine=engine):
+    if error is not None:
+      print ("Failed to measure {}: {}".format(name, error))
+      continue
+    darkness[name], width[name], angle[name] = dark, wide, slant
 
-  # normalize weight values:
-  min_dark, max_dark = find_extremes(darkness)
-  dark_range = max_dark - min_dark
+  if not darkness:
+    return {}, {}, {}
 
-  if dark_range == 0: # unlikely
-    weights = {name: 5 for name, _ in fonts}
-  else:
-    weights = {}
-    for name, _ in fonts:
-      weights[name] = min(10, int(1 + floor(10 * ((darkness[name] - min_dark)/ dark_range))))
+  # normalization needs every raw value, so it only happens
+  # once all of the measurements have been collected:
+  return (normalize(darkness), normalize(width),
+          {name: angle_score(value) for name, value in angle.items()})
 
-  # normalize width values:
-  min_width, max_width = find_extremes(width)
-  width_range = max_width - min_width
 
-  if width_range == 0: # unlikely
-    widths = {name: 5 for name, _ in fonts}
-  else:
-    widths = {}
-    for name, _ in fonts:
-      widths[name] = min(10, int(1 + floor(10 * ((width[name] - min_width)/ width_range))))
+RAW_HEADER = ["GFN", "DARKNESS", "WIDTH", "SHARD", "ANGLE"]
+
+
+def shard_of(gfn, count):
+  """Stable shard number of a GFN, from 0 to count-1. It only depends on
+     the GFN itself, so every machine assigns fonts to the same shards."""
+  return int(hashlib.sha1(gfn.encode("utf-8")).hexdigest(), 16) % count
+
+
+def append_raw_measurements(filename, measurements, shard=None):
+  """Appends (gfn, darkness, width, angle) rows to a raw measurements
+     file, writing the header first if the file is new. shard is the
+     "i/N" spec of the shard the measurements belong to, if any."""
+  new_file = not os.path.exists(filename) or os.path.getsize(filename) == 0
+  with open(filename, 'a') as rawfile:
+    writer = csv.writer(rawfile, delimiter=',', quotechar='"', lineterminator='\n')
+    if new_file:
+      writer.writerow(RAW_HEADER)
+    for gfn, darkness, width, angle in measurements:
+      writer.writerow([gfn, repr(darkness), repr(width), shard or '',
+                       repr(angle) if angle is not None else ''])
+
+
+def read_raw_rows(filename):
+  """Yields the (gfn, darkness, width, angle, shard) rows of a raw
+     measurements file. shard is None for rows not measured as part of
+     a shard, and angle is None in files written before angles were
+     measured."""
+  with open(filename) as rawfile:
+    reader = csv.reader(rawfile, delimiter=',', quotechar='"')
+    next(reader) # skip the header
+    for row in reader:
+      shard = row[3] if len(row) > 3 and row[3] else None
+      angle = float(row[4]) if len(row) > 4 and row[4] else None
+      yield row[0], float(row[1]), float(row[2]), angle, shard
 
-  return weights, widths
+
+def read_raw_measurements(filename):
+  """Reads a raw measurements file into three dicts gfn:darkness,
+     gfn:width and gfn:angle (the latter without the GFNs whose angle
+     wasn't measured). Later rows override earlier ones for the same
+     GFN, so re-measuring a font only takes appending its new values."""
+  darkness = collections.OrderedDict()
+  width = collections.OrderedDict()
+  angle = collections.OrderedDict()
+  for gfn, dark, wide, slant, _ in read_raw_rows(filename):
+    darkness[gfn] = dark
+    width[gfn] = wide
+    if slant is not None:
+      angle[gfn] = slant
+    else:
+      angle.pop(gfn, None)
+  return darkness, width, angle
 
 
 def save_csv(filename, metadata, cleanup_for_publishing=False):
+  """Writes a MetadataTable (or a dict of gfn:{field:value} dicts)
+     to a CSV file, sorted by GFN."""
   with open(filename, 'w') as csvfile:
     writer = csv.writer(csvfile, delimiter=',', quotechar='"', lineterminator='\n')
     header = ["GFN","FWE","FIA","FWI","USAGE"]
@@ -79,8 +294,161 @@ def save_csv(filename, metadata, cleanup_for_publishing=False):
       writer.writerow(row)
 
 
+class MetadataRow(object):
+  """Dict-like view of one row of a MetadataTable."""
+
+  def __init__(self, table, gfn):
+    self._table = table
+    self._gfn = gfn
+
+  def __getitem__(self, key):
+    return self._table.get_value(self._gfn, key)
+
+  def __setitem__(self, key, value):
+    self._table.set_value(self._gfn, key, value)
+
+  def get(self, key, default=None):
+    try:
+      return self[key]
+    except KeyError:
+      return default
+
+  def keys(self):
+    return list(MetadataTable.FIELDS)
+
+  def __iter__(self):
+    return iter(MetadataTable.FIELDS)
+
+  def __contains__(self, key):
+    return key in MetadataTable.FIELDS
+
+  def items(self):
+    return [(key, self[key]) for key in MetadataTable.FIELDS]
+
+  def __repr__(self):
+    return repr(dict(self.items()))
+
+
+class MetadataTable(object):
+  """Font metadata (the contents of the metadata CSV) stored column-wise.
+
+  The integer scores live in typed arrays, the usage and subsets strings
+  are interned into a small table of distinct values and stored as codes,
+  and a dict maps each GFN to its row. For old callers, the table behaves
+  like the dict of gfn:{field:value} dicts that read_csv used to return.
+  """
+  INT_FIELDS = ("weight_int", "angle_int", "width_int")
+  STRING_FIELDS = ("usage", "subsets")
+  FIELDS = INT_FIELDS + STRING_FIELDS
+
+  def __init__(self):
+    self.gfns = []
+    self.index = {}
+    self.columns = {field: array('h') for field in self.INT_FIELDS}
+    self.columns.update({field: array('H') for field in self.STRING_FIELDS})
+    self.strings = []
+    self._string_codes = {}
+
+  def _intern(self, value):
+    code = self._string_codes.get(value)
+    if code is None:
+      code = self._string_codes[value] = len(self.strings)
+      self.strings.append(value)
+    return code
+
+  def append(self, gfn, weight_int, angle_int, width_int, usage, subsets=None):
+    if gfn in self.index:
+      self[gfn] = {"weight_int": weight_int, "angle_int": angle_int,
+                   "width_int": width_int, "usage": usage, "subsets": subsets}
+      return
+    self.index[gfn] = len(self.gfns)
+    self.gfns.append(gfn)
+    self.columns["weight_int"].append(weight_int)
+    self.columns["angle_int"].append(angle_int)
+    self.columns["width_int"].append(width_int)
+    self.columns["usage"].append(self._intern(usage))
+    self.columns["subsets"].append(self._intern(subsets))
+
+  def get_value(self, gfn, field):
+    row = self.index[gfn]
+    if field in self.STRING_FIELDS:
+      return self.strings[self.columns[field][row]]
+    return self.columns[field][row]
+
+  def set_value(self, gfn, field, value):
+    row = self.index[gfn]
+    if field in self.STRING_FIELDS:
+      value = self._intern(value)
+    elif field not in self.INT_FIELDS:
+      raise KeyError(field)
+    self.columns[field][row] = value
+
+  def column_values(self, field):
+    """Returns a list with the value of field for every row,
+       in the same order as self.gfns."""
+    if field in self.STRING_FIELDS:
+      return [self.strings[code] for code in self.columns[field]]
+    return list(self.columns[field])
+
+  # dict-style access:
+
+  def __getitem__(self, gfn):
+    if gfn not in self.index:
+      raise KeyError(gfn)
+    return MetadataRow(self, gfn)
+
+  def __setitem__(self, gfn, data):
+    if gfn not in self.index:
+      self.append(gfn, data["weight_int"], data["angle_int"],
+                  data["width_int"], data["usage"], data.get("subsets"))
+    else:
+      for field in self.INT_FIELDS:
+        self.set_value(gfn, field, data[field])
+      for field in self.STRING_FIELDS:
+        self.set_value(gfn, field, data.get(field))
+
+  def __delitem__(self, gfn):
+    # move the last row into the deleted one's place:
+    row = self.index.pop(gfn)
+    last_gfn = self.gfns.pop()
+    for column in self.columns.values():
+      last = column.pop()
+      if last_gfn != gfn:
+        column[row] = last
+    if last_gfn != gfn:
+      self.gfns[row] = last_gfn
+      self.index[last_gfn] = row
+
+  def __contains__(self, gfn):
+    return gfn in self.index
+
+  def __iter__(self):
+    return iter(list(self.gfns))
+
+  def __len__(self):
+    return len(self.gfns)
+
+  def keys(self):
+    # (a set-like view: membership tests go through self.index, and
+    # iterating it, like iterating the table, allows deleting rows)
+    return collections.abc.KeysView(self)
+
+  def values(self):
+    return [MetadataRow(self, gfn) for gfn in self.gfns]
+
+  def items(self):
+    return [(gfn, MetadataRow(self, gfn)) for gfn in self.gfns]
+
+
+def _int_or_unknown(value):
+  """Empty cells (as written by save_csv when cleaning up
+     for publishing) are read back as -1."""
+  return int(value) if value != '' else -1
+
+
 def read_csv(filename):
-  metadata = {}
+  """Reads a metadata CSV file, one row at a time, into a MetadataTable."""
+  metadata = MetadataTable()
   with open(filename) as csvfile:
     existing_data = csv.reader(csvfile, delimiter=',', quotechar='"')
     next(existing_data) # skip first row as its not data
@@ -91,18 +459,19 @@ def read_csv(filename):
       else:
         subsets = row[5]
 
-      metadata[gfn] = {
-        "weight_int": int(row[1]),
-        "angle_int": int(row[2]),
-        "width_int": int(row[3]),
-        "usage": row[4],
-        "subsets": subsets
-      }
+      metadata.append(gfn,
+                      _int_or_unknown(row[1]),
+                      _int_or_unknown(row[2]),
+                      _int_or_unknown(row[3]),
+                      row[4],
+                      subsets)
   return metadata
 
 
 # Fonts that cause problems: any filenames containing these letters
-# will be skipped.
+# will be skipped. New offenders don't need to be added here anymore:
+# fonts that hang or crash a supervised worker get quarantined
+# automatically (see supervised_pool.py).
 # TODO: Investigate why these don't work.
 BLOCKLIST = [
 ##IOError: execution context too long (issue #703)
@@ -138,7 +507,18 @@ def is_blocklisted(filename):
 # Sample code below was copied from
 # https://www.cairographics.org/cookbook/freetypepython/
 import ctypes as ct
-import cairo
+try:
+  import cairo
+except ImportError:
+  cairo = None
+
+
+def require_cairo():
+  """Exits with an installation hint if pycairo is missing. Everything
+     that renders fonts needs it, reading and writing CSVs does not."""
+  if cairo is None:
+    sys.exit("Needs pycairo.\n\npip3 install pycairo")
+
 class PycairoContext(ct.Structure):
     _fields_ = \
         [
@@ -148,7 +528,7 @@ class PycairoContext(ct.Structure):
         ]
 
 _initialized = False
-def create_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0):
+def _load_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0):
     "given the name of a font file, and optional faceindex to pass to FT_New_Face" \
     " and loadoptions to pass to cairo_ft_font_face_create_for_ft_face, creates" \
     " a cairo.FontFace object that may be used to render text with that font."
@@ -175,6 +555,8 @@ def create_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0):
         _cairo_so.cairo_font_face_status.argtypes = [ ct.c_void_p ]
         _cairo_so.cairo_font_face_destroy.argtypes = (ct.c_void_p,)
         _cairo_so.cairo_status.argtypes = [ ct.c_void_p ]
+        _freetype_so.FT_Get_Sfnt_Table.restype = ct.c_void_p
+        _freetype_so.FT_Get_Sfnt_Table.argtypes = [ ct.c_void_p, ct.c_int ]
         # initialize freetype
         _ft_lib = ct.c_void_p()
         status = _freetype_so.FT_Init_FreeType(ct.byref(_ft_lib))
@@ -192,6 +574,7 @@ def create_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0):
         status = _freetype_so.FT_New_Face(_ft_lib, filename.encode("utf-8"), faceindex, ct.byref(ft_face))
         if status != FT_Err_Ok :
             raise RuntimeError("Error %d creating FreeType font face for %s" % (status, filename))
+        style = _ft_face_style(ft_face)
 
         # create Cairo font face for freetype face
         cr_face = _cairo_so.cairo_ft_font_face_create_for_ft_face(ft_face, loadoptions)
@@ -225,17 +608,209 @@ def create_cairo_font_face_for_file (filename, faceindex=0, loadoptions=0):
         cairo_ctx = cairo.Context(_surface)
         cairo_t = PycairoContext.from_address(id(cairo_ctx)).ctx
         _cairo_so.cairo_set_font_face(cairo_t, cr_face)
-        status = _cairo_so.cairo_font_face_status(cairo_t)
+        status = _cairo_so.cairo_status(cairo_t)
         if status != CAIRO_STATUS_SUCCESS :
             raise RuntimeError("Error %d creating cairo font face for %s" % (status, filename))
 
+        # get back Cairo font face as a Python object
+        face = cairo_ctx.get_font_face()
+
     finally :
         _cairo_so.cairo_font_face_destroy(cr_face)
         _freetype_so.FT_Done_Face(ft_face)
 
-    # get back Cairo font face as a Python object
-    face = cairo_ctx.get_font_face()
-    return face
+    return face, style
+
+
+FaceStyle = collections.namedtuple('FaceStyle', ['italic_angle', 'italic'])
+
+FT_SFNT_POST = 5
+FT_STYLE_FLAG_ITALIC = 1
+
+def _ft_face_style(ft_face):
+  """Reads the post table italicAngle and the italic style flag of a
+     FreeType face, so that measuring the angle needs no other file open."""
+  # style_flags is the fourth FT_Long of FT_FaceRec:
+  style_flags = ct.cast(ft_face, ct.POINTER(ct.c_long))[3]
+  italic_angle = 0.0
+  post = _freetype_so.FT_Get_Sfnt_Table(ft_face, FT_SFNT_POST)
+  if post:
+    # TT_Postscript starts with the FT_Fixed (16.16) FormatType and italicAngle:
+    italic_angle = ct.cast(post, ct.POINTER(ct.c_long))[1] / 65536.0
+  return FaceStyle(italic_angle, bool(style_flags & FT_STYLE_FLAG_ITALIC))
+
+
+# Font faces are cached by (path, mtime, faceindex, loadoptions).
+# Each cached cairo.FontFace owns its FreeType face: cairo calls
+# FT_Done_Face (attached above as user data) once the last reference
+# to the font face is gone, so evicting an entry releases the FreeType
+# face as soon as nobody is rendering with it anymore.
+FACE_CACHE_SIZE = 32
+_face_cache = collections.OrderedDict()
+# The web tool renders on its request threads: this lock guards the face
+# cache and the loading of faces (FreeType faces must not be used by two
+# threads at once either, see render_sample).
+_face_lock = threading.RLock()
+
+def set_face_cache_size(size):
+  """Sets the maximum number of font faces kept open by
+     create_cairo_font_face_for_file. Zero disables the cache."""
+  global FACE_CACHE_SIZE
+  with _face_lock:
+    FACE_CACHE_SIZE = size
+    _trim_face_cache()
+
+
+def clear_face_cache():
+  """Drops every cached font face, releasing their FreeType faces."""
+  with _face_lock:
+    _face_cache.clear()
+
+
+def _trim_face_cache():
+  while len(_face_cache) > FACE_CACHE_SIZE:
+    _face_cache.popitem(last=False)
+
+
+def _cached_font_face(filename, faceindex=0, loadoptions=0):
+  """Returns the (cairo.FontFace, FaceStyle) of a font file, reusing a
+     previously created face for the same file whenever possible."""
+  key = (os.path.abspath(filename), os.path.getmtime(filename),
+         faceindex, loadoptions)
+  with _face_lock:
+    entry = _face_cache.pop(key, None)
+    if entry is None:
+      entry = _load_cairo_font_face_for_file(filename, faceindex, loadoptions)
+    if FACE_CACHE_SIZE > 0:
+      _face_cache[key] = entry # most recently used entries go last
+      _trim_face_cache()
+    return entry
+
+
+def create_cairo_font_face_for_file(filename, faceindex=0, loadoptions=0):
+  """Returns a cairo.FontFace for the given font file, reusing a
+     previously created face for the same file whenever possible."""
+  return _cached_font_face(filename, faceindex, loadoptions)[0]
+
+
+def _alpha_coverage_numpy(surface):
+  """Mean alpha of an A8 surface, summed as integers over a zero-copy
+     NumPy view of the pixel buffer. Rows are addressed through the stride,
+     so the padding at the end of each row is never read.
+  """
+  width = surface.get_width()
+  height = surface.get_height()
+  stride = surface.get_stride()
+  pixels = numpy.frombuffer(surface.get_data(), dtype=numpy.uint8,
+                            count=height * stride)
+  pixels = pixels.reshape(height, stride)[:, :width]
+  total = int(pixels.sum(dtype=numpy.uint64))
+  return total / (255.0 * width * height)
+
+
+def _alpha_coverage_reference(surface):
+  """Mean alpha of an A8 surface, one pixel at a time.
+     Slow, but kept around to validate the other reduction modes.
+  """
+  pixel_data = bytearray(surface.get_data())
+  data_width = surface.get_width()
+  data_stride = surface.get_stride()
+  data_height = surface.get_height()
+
+  avg = 0.0
+  for x in range(data_width):
+    for y in range(data_height):
+      alpha = pixel_data[y*data_stride + x]
+      avg += alpha/255.0
+
+  return avg / (data_width * data_height)
+
+
+REDUCTIONS = {
+  "numpy": _alpha_coverage_numpy,
+  "reference": _alpha_coverage_reference,
+}
+
+
+def alpha_coverage(surface, reduction=None):
+  """Returns the mean alpha of an A8 surface, from 0.0 to 1.0.
+
+     reduction is one of the REDUCTIONS keys. "reference" is the original
+     per-pixel loop; "numpy" should agree with it to within float rounding.
+  """
+  if reduction is None:
+    reduction = "numpy" if numpy is not None else "reference"
+  if reduction == "numpy" and numpy is None:
+    raise RuntimeError("The 'numpy' reduction needs numpy.\n\npip3 install numpy")
+
+  return REDUCTIONS[reduction](surface)
+
+
+def estimate_slant(surface, max_angle=30.0, step=0.5):
+  """Estimates the slant of the text rendered on an A8 surface, in
+     degrees (positive leaning to the right), as the shear that makes
+     the stems line up best: undoing the actual slant yields the most
+     sharply peaked column profile. Needs NumPy; returns 0.0 without it.
+  """
+  if numpy is None:
+    return 0.0
+  width = surface.get_width()
+  height = surface.get_height()
+  stride = surface.get_stride()
+  pixels = numpy.frombuffer(surface.get_data(), dtype=numpy.uint8,
+                            count=height * stride)
+  pixels = pixels.reshape(height, stride)[:, :width].astype(numpy.float64)
+  # the rows' heights above the bottom of the raster:
+  heights = numpy.arange(height)[::-1]
+
+  best_angle, best_score = 0.0, None
+  # (from upright outwards, so that ties go to the smallest slant)
+  for angle in sorted(numpy.arange(-max_angle, max_angle + step / 2, step), key=abs):
+    shifts = numpy.round(heights * numpy.tan(numpy.radians(angle))).astype(int)
+    profile = numpy.zeros(width + shifts.max() - shifts.min())
+    for y in range(height):
+      # shifting each row left by its shift undoes a right slant:
+      offset = shifts.max() - shifts[y]
+      profile[offset:offset + width] += pixels[y]
+    score = numpy.dot(profile, profile)
+    if best_score is None or score > best_score:
+      best_angle, best_score = float(angle), score
+  return best_angle
+
+
+def alpha_png(width, height, stride, pixel_data):
+  """Encodes an 8-bit alpha raster (rows of `stride` bytes) as a PNG
+     of black ink on a transparent background and returns its bytes.
+  """
+  raw = bytearray()
+  black = bytes(bytearray(width))
+  for y in range(height):
+    alpha = pixel_data[y*stride:y*stride + width]
+    row = bytearray(2 * width)
+    row[0::2] = black
+    row[1::2] = alpha
+    raw += b'\0' + row # filter type "None"
+
+  def chunk(tag, data):
+    return (struct.pack(">I", len(data)) + tag + data +
+            struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff))
+
+  return (b'\x89PNG\r\n\x1a\n' +
+          chunk(b'IHDR', struct.pack(">IIBBBBB", width, height, 8, 4, 0, 0, 0)) +
+          chunk(b'IDAT', zlib.compress(bytes(raw), 6)) +
+          chunk(b'IEND', b''))
+
+
+def coverage_png(surface):
+  """Encodes an A8 surface as a PNG of black ink on a transparent
+     background and returns its bytes.
+
+     cairo would write an A8 surface as white-on-black grayscale, so the
+     PNG (8-bit gray + alpha) is assembled by alpha_png instead.
+  """
+  surface.flush()
+  return alpha_png(surface.get_width(), surface.get_height(),
+                   surface.get_stride(), bytes(surface.get_data()))
 
 
 FONT_SIZE=30
@@ -245,58 +820,211 @@ LATIN_TEXT = "AaBbCcDdEeFfGgHhIiJjKkLlMmNnOoPpQqRrSsTtUuVvXxYyZz"
 KHMER_TEXT = "\xE1\x9E\x9A\xE1\x9E\x9B\xE1\x9E\x80\xE1\x9E\x94\xE1\x9E\x80\xE1\x9F\x8B\xE1\x9E\x94\xE1\x9F\x84\xE1\x9E\x80\xE1\x9E\x93\xE1\x9E\xB6\xE1\x9E\x9B\xE1\x9F\x92\xE1\x9E\x84\xE1\x9E\xB6\xE1\x9E\x85\xE1\x9E\x8A\xE1\x9F\x8F\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x84\xE1\x9E\x85\xE1\x9E\x80\xE1\x9E\x8E\xE1\x9F\x92\xE1\x9E\x8F\xE1\x9F\x82\xE1\x9E\x84"
 
 
-def compute_darkness_and_width(fontfile, subsets):
-  """Returns the darkness and width of a given a TTF.
+# Bump this whenever a change to the rendering or to the reduction
+# code alters the raw measurements, so that cached values get discarded.
+MEASUREMENT_VERSION = 2
 
-     Darkness value is a percentage
-     Width is in pixels
 
-     Both values should be normalized.
+def sample_texts(subsets):
+  """Returns the (sample_text, sample_xheight) pair used to measure
+     a font supporting the given subsets.
   """
-  print ("Computing... {}".format(fontfile))
-
   #TODO: There should be a dict of sample strings per subset
   # instead of just the khmer special case below:
-  if 'khmer' in subsets:
-    sample_text = KHMER_TEXT
-    sample_xheight = '\xE1\x9E\x85'
+  if subsets and 'khmer' in subsets:
+    return KHMER_TEXT, '\xE1\x9E\x85'
   else:
-    sample_text = LATIN_TEXT
-    sample_xheight = 'x'
+    return LATIN_TEXT, 'x'
 
-  face = create_cairo_font_face_for_file(fontfile, 0)
 
-  #dummy surface
-  surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, 0, 0)
-  ctx = cairo.Context(surface)
-  ctx.set_font_face(face)
-  ctx.set_font_size(FONT_SIZE)
-  xbearing, ybearing, text_width, text_height, _, _ = ctx.text_extents(sample_text)
-  _, _, _, x_height, _, _ = ctx.text_extents(sample_xheight)
+def file_digest(filename):
+  """Returns the SHA-1 hex digest of a file's contents."""
+  digest = hashlib.sha1()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(1 << 20), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
 
 
-  #actual surface
-  surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, int(text_width), int(text_height))
-  ctx = cairo.Context(surface)
+_digests = {}
 
-  ctx.set_font_face(face)
-  ctx.set_font_size(FONT_SIZE)
-  ctx.move_to(-xbearing, -ybearing)
-  ctx.show_text(sample_text)
+def font_digest(fontfile):
+  """Like file_digest, but only reads the file again when its path,
+     mtime or size changed."""
+  st = os.stat(fontfile)
+  stamp = (os.path.abspath(fontfile), st.st_mtime, st.st_size)
+  if stamp not in _digests:
+    _digests[stamp] = file_digest(fontfile)
+  return _digests[stamp]
 
-  pixel_data = surface.get_data()
-  data_width = surface.get_width()
-  data_stride = surface.get_stride()
-  data_height = surface.get_height()
 
-  avg = 0.0
-  for x in xrange(data_width):
-    for y in xrange(data_height):
-      alpha = ord(pixel_data[y*data_stride + 4*x + 3])
-      avg += alpha/255.0
+def format_variations(coordinates):
+  """Formats (axis tag, value) pairs as a "wght=700,wdth=100" string,
+     the format taken by cairo.FontOptions.set_variations."""
+  return ",".join("{}={:g}".format(tag, value) for tag, value in coordinates)
+
+
+def parse_variations(variations):
+  """Turns "wght=700,wdth=100" into a dict location."""
+  location = {}
+  for coordinate in variations.split(","):
+    tag, value = coordinate.split("=")
+    location[tag.strip()] = float(value)
+  return location
+
+
+def instance_slant(angle, italic, location):
+  """Returns the (italic angle, italic) of the instance at location (a
+     dict tag:value) of a variable font whose default instance has the
+     given italic angle and italic style: the slnt axis sets the angle,
+     and the ital axis whether the instance is an italic."""
+  if "ital" in location:
+    italic = location["ital"] >= 0.5
+    if not italic:
+      angle = 0.0
+  elif "slnt" in location:
+    # obliques are their slant, and nothing else:
+    italic = False
+  if "slnt" in location:
+    angle = 0.0 - location["slnt"]
+  return angle, italic
+
+
+def render_key(fontfile, subsets, engine="raster", variations=None):
+  """Returns a key identifying the result of rendering fontfile: it
+     changes with the file contents, the sample text, the font size,
+     MEASUREMENT_VERSION, the measurement engine and the variation
+     coordinates, but not with the file's name or location."""
+  sample_text, sample_xheight = sample_texts(subsets)
+  params = [sample_text, sample_xheight, str(FONT_SIZE), str(MEASUREMENT_VERSION)]
+  # (keys of raster measurements of default instances predate engines
+  # and variations, and stay as they were)
+  if engine != "raster":
+    params.append(engine)
+  if variations:
+    params.append(variations)
+  params = u"\0".join(params)
+  params_digest = hashlib.sha1(params.encode("utf-8")).hexdigest()
+  return "{}-{}".format(font_digest(fontfile), params_digest)
+
+
+SampleRender = collections.namedtuple(
+    'SampleRender', ['surface', 'text_width', 'x_height', 'style'])
+
+
+def render_sample(fontfile, subsets, variations=None):
+  """Renders the sample text of a font into an A8 coverage raster.
+
+     This is the only place where fonts get rasterized: the darkness and
+     width measurements as well as the PNG thumbnails are computed from
+     the SampleRender returned here.
+     variations selects an instance of a variable font, given as
+     "wght=700,wdth=100" variation coordinates.
+  """
+  sample_text, sample_xheight = sample_texts(subsets)
+
+  # (one thread at a time, since cached faces are shared)
+  with _face_lock:
+    with profiling.stage("face", fontfile):
+      face, style = _cached_font_face(fontfile, 0)
+
+    with profiling.stage("render", fontfile):
+      font_matrix = cairo.Matrix(xx=FONT_SIZE, yy=FONT_SIZE)
+      options = cairo.FontOptions()
+      if variations:
+        options.set_variations(variations)
+      scaled_font = cairo.ScaledFont(face, font_matrix, cairo.Matrix(), options)
+      xbearing, ybearing, text_width, text_height, _, _ = scaled_font.text_extents(sample_text)
+      _, _, _, x_height, _, _ = scaled_font.text_extents(sample_xheight)
+
+      surface = cairo.ImageSurface(cairo.FORMAT_A8, int(text_width), int(text_height))
+      ctx = cairo.Context(surface)
+      ctx.set_scaled_font(scaled_font)
+      ctx.move_to(-xbearing, -ybearing)
+      ctx.show_text(sample_text)
+      del ctx
+      surface.flush()
+
+  return SampleRender(surface, text_width, x_height, style)
+
+
+# Ways of measuring darkness and width: "raster" renders the sample
+# text with cairo, "outline" computes the ink from the glyph outlines
+# (see outlines.py), and needs neither cairo nor FreeType.
+ENGINES = ["raster", "outline"]
+
+
+Measurement = collections.namedtuple('Measurement', ['darkness', 'width', 'angle'])
+
+
+def raster_angle(render, variations=None):
+  """The italic angle of a rendered font, in degrees, positive leaning to
+     the right: post.italicAngle, or for instances of variable fonts the
+     slnt coordinate. Italics that leave both at 0 get their slant
+     estimated from the raster instead."""
+  angle, italic = 0.0 - render.style.italic_angle, render.style.italic
+  if variations:
+    angle, italic = instance_slant(angle, italic, parse_variations(variations))
+  if angle == 0 and italic:
+    angle = estimate_slant(render.surface)
+  return angle
+
+
+def measure_font(fontfile, subsets, reduction=None, render=None, engine="raster",
+                 variations=None):
+  """Returns the Measurement (darkness, width and italic angle) of a
+     given TTF, all taken from the same rendering or font load.
+
+     Darkness value is a percentage
+     Width is in multiples of the x-height
+     Angle is in degrees, positive leaning to the right
+
+     Darkness and width should be normalized, see angle_score for the angle.
+
+     reduction selects how the rendered pixels are summed up, see
+     alpha_coverage. Defaults to "numpy" when NumPy is available.
+     An already computed render_sample() result can be passed in
+     to avoid rasterizing the font again.
+     engine is one of ENGINES, and variations selects an instance of a
+     variable font (see render_sample).
+  """
+  if variations:
+    print ("Computing... {} ({})".format(fontfile, variations))
+  else:
+    print ("Computing... {}".format(fontfile))
+
+  if engine == "outline":
+    from outlines import measure_outlines
+    with profiling.stage("outline", fontfile):
+      return Measurement(*measure_outlines(fontfile, *sample_texts(subsets),
+                                           variations=variations))
+  elif engine != "raster":
+    raise ValueError("Unknown measurement engine: {}".format(engine))
+
+  if render is None:
+    render = render_sample(fontfile, subsets, variations)
+
+  with profiling.stage("reduce", fontfile):
+    darkness = alpha_coverage(render.surface, reduction)
+
+  width = render.text_width / float(render.x_height)
+
+  with profiling.stage("angle", fontfile):
+    angle = raster_angle(render, variations)
+
+  return Measurement(darkness, width, angle)
+
 
-  darkness = avg / (data_width * data_height)
+def compute_darkness_and_width(fontfile, subsets, reduction=None, render=None, engine="raster",
+                               variations=None):
+  """Returns the darkness and width of a given a TTF,
+     see measure_font."""
+  return measure_font(fontfile, subsets, reduction, render, engine, variations)[:2]
 
-  width = text_width / float(x_height)
 
-  return darkness, width
+def angle_score(angle):
+  """Bins an italic angle in degrees into a score from 1 (upright) to 10,
+     3 degrees apart like the angle_N.png backgrounds of the web tool.
+     Unlike weight and width, angles are not normalized: a collection
+     of upright fonts should not get spread across the whole range."""
+  return min(10, 1 + int(floor(abs(angle) / 3.0 + 0.5)))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""Measuring the instances of variable fonts.
+
+A variable font gets measured once per instance: the named instances of
+its fvar table, or every point of an axis grid given by the user. All of
+the instances are measured from a single load of the font file, by
+setting the variation coordinates on the same cairo/FreeType face (or on
+the same TTFont, with the outline engine), and each one gets its own GFN.
+"""
+import collections
+import itertools
+import sys
+
+try:
+  from fontTools.ttLib import TTFont
+except ImportError:
+  sys.exit("Needs fontTools.\n\npip3 install fonttools")
+
+import profiling
+from util import (format_variations,
+                  instance_slant,
+                  measure_font,
+                  sample_texts)
+
+# coordinates is a tuple of (axis tag, value) pairs, in fvar axis order,
+# so that instances can be used as dict keys.
+Instance = collections.namedtuple('Instance', ['name', 'coordinates'])
+
+
+def variations(instance):
+  """The coordinates of an instance as a "wght=700,wdth=100" string."""
+  return format_variations(instance.coordinates)
+
+
+def parse_axis_grid(specs):
+  """Parses a list of "tag=values" axis grid specifications, where values
+     is either a comma separated list or a start:stop:step range (both
+     ends included), into an OrderedDict tag:[values]."""
+  grid = collections.OrderedDict()
+  for spec in specs:
+    try:
+      tag, values = spec.split("=")
+      if ":" in values:
+        start, stop, step = [float(v) for v in values.split(":")]
+        count = int(round((stop - start) / step)) + 1
+        grid[tag] = [start + i * step for i in range(count)]
+      else:
+        grid[tag] = [float(v) for v in values.split(",")]
+    except ValueError:
+      raise ValueError("Bad axis grid '{}', expected eg wght=100:900:100"
+                       " or wdth=75,100".format(spec))
+  return grid
+
+
+def font_instances(fontfile, axis_grid=None):
+  """Returns the list of Instances of a variable font to measure: the
+     fvar named instances or, given an axis_grid (see parse_axis_grid),
+     every combination of the grid values. Axes missing from the grid
+     stay at their default, and values beyond an axis' range are clamped.
+     Returns None for static fonts."""
+  ttfont = TTFont(fontfile, lazy=True)
+  try:
+    if 'fvar' not in ttfont:
+      return None
+    axes = ttfont['fvar'].axes
+    if not axis_grid:
+      name_table = ttfont['name']
+      return [Instance(name_table.getDebugName(instance.subfamilyNameID),
+                       tuple((axis.axisTag, instance.coordinates[axis.axisTag])
+                             for axis in axes))
+              for instance in ttfont['fvar'].instances]
+
+    values = []
+    for axis in axes:
+      points = axis_grid.get(axis.axisTag, [axis.defaultValue])
+      values.append(sorted(set(min(axis.maxValue, max(axis.minValue, v)) for v in points)))
+    instances = []
+    for point in itertools.product(*values):
+      coordinates = tuple(zip([axis.axisTag for axis in axes], point))
+      instance = Instance(None, coordinates)
+      instances.append(instance._replace(name=variations(instance)))
+    return instances
+  finally:
+    ttfont.close()
+
+
+def instance_gfn(font_gfn, instance):
+  """The GFN of an instance of a variable font whose own GFN is
+     font_gfn: same family, with the style and weight of the instance."""
+  family, style, weight = font_gfn.split(":")
+  coordinates = dict(instance.coordinates)
+  if "wght" in coordinates:
+    weight = int(round(coordinates["wght"]))
+  if "ital" in coordinates or "slnt" in coordinates:
+    italic = coordinates.get("ital", 0) >= 0.5 or coordinates.get("slnt", 0) != 0
+    style = "italic" if italic else "normal"
+  if instance.name and "Italic" in instance.name:
+    style = "italic"
+  return "{}:{}:{}".format(family, style, weight)
+
+
+def measure_instances(fontfile, subsets, instances, engine="raster"):
+  """Measures a list of Instances of a variable font, loading it only
+     once. Returns a list of (instance, darkness, width, angle, error)
+     tuples."""
+  rows = []
+  if engine == "outline":
+    from outlines import measure_glyphset, font_slant, outline_angle
+    print ("Computing... {} ({} instances)".format(fontfile, len(instances)))
+    sample_text, sample_xheight = sample_texts(subsets)
+    ttfont = TTFont(fontfile, lazy=True)
+    try:
+      cmap = ttfont.getBestCmap()
+      slant = font_slant(ttfont)
+      for instance in instances:
+        try:
+          with profiling.stage("outline", fontfile, instance=instance.name):
+            location = dict(instance.coordinates)
+            glyphset = ttfont.getGlyphSet(location=location)
+            darkness, width = measure_glyphset(glyphset, cmap, sample_text, sample_xheight)
+            angle, italic = instance_slant(*slant, location)
+            angle = outline_angle(glyphset, cmap, sample_text, angle, italic)
+          rows.append((instance, darkness, width, angle, None))
+        except Exception as e:
+          rows.append((instance, None, None, None, "{}: {}".format(type(e).__name__, e)))
+    finally:
+      ttfont.close()
+  else:
+    # the cairo font face is cached, so all of the instances
+    # get rendered from the same FreeType face:
+    for instance in instances:
+      try:
+        measurement = measure_font(fontfile, subsets, engine=engine,
+                                   variations=variations(instance))
+        rows.append((instance,) + tuple(measurement) + (None,))
+      except Exception as e:
+        rows.append((instance, None, None, None, "{}: {}".format(type(e).__name__, e)))
+  return rows